@@ -1,10 +1,14 @@
+import asyncio
 import os
 import logging
+from datetime import datetime
 from typing import Optional, List
-from fastapi import FastAPI, APIRouter, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from utils import load_config, logging_setup
 from api.api_service import APIService
-from api.api_model import TwitchBotStatus, TwitchMessage, UserAuth, RallyInfo
+from api.api_model import TwitchBotStatus, TwitchMessage, TwitchMessageBatch, TwitchMessageColumns, UserAuth, RallyInfo
 
 
 cfg = load_config(os.environ.get('CONFIG_FILE', 'configs/default.yml'))
@@ -20,14 +24,32 @@ def read_root():
 
 
 @router.get('/twitch/status', response_model=TwitchBotStatus)
-def get_twitch_bot_status():
+def get_twitch_bot_status(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get the bot status. Send the last ETag in If-None-Match to get a 304 when unchanged."""
+    etag = api_service.twitch_status_etag
+    if if_none_match == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
     return api_service.get_twitch_bot_status()
 
 
+@router.get('/twitch/status/wait', response_model=TwitchBotStatus)
+async def wait_twitch_bot_status(response: Response, if_none_match: Optional[str] = Header(None),
+                                 timeout: float = Query(30, ge=0, le=120)):
+    """Long-poll for a status change: returns as soon as the status no longer matches
+    If-None-Match, or a 304 after `timeout` seconds without change."""
+    await api_service.wait_for_twitch_bot_status(if_none_match, timeout)
+    status, etag = await api_service.read_twitch_bot_status()
+    if if_none_match == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    return status
+
+
 @router.patch('/twitch/status')
-def set_twitch_bot_status(status: TwitchBotStatus):
+async def set_twitch_bot_status(status: TwitchBotStatus):
     """Set config status for the API and twitch bot."""
-    api_service.set_twitch_bot_status(status)
+    await api_service.set_twitch_bot_status(status)
 
 
 @router.post('/twitch/message')
@@ -36,13 +58,76 @@ async def new_twitch_message(message: TwitchMessage):
     await api_service.handle_twitch_message(message)
 
 
+@router.post('/twitch/messages')
+async def new_twitch_messages(batch: TwitchMessageBatch):
+    """Accepts a batch of new Twitch messages from the bot, in order."""
+    await api_service.handle_twitch_messages(batch.messages)
+
+
+@router.post('/twitch/messages/columns')
+async def new_twitch_message_columns(columns: TwitchMessageColumns):
+    """Accepts a batch of new Twitch messages from the bot as columns, validated in bulk."""
+    await api_service.handle_twitch_message_columns(columns)
+
+
 @router.get('/twitch/get_messages')
-def get_messages(seconds_history: int = None, channel_names: Optional[List[str]] = Query(None)):
+def get_messages(seconds_history: int = None, channel_names: Optional[List[str]] = Query(None),
+                 after: int = None):
+    """Get stored messages. Pass `after` (a cursor) to only get messages newer than it."""
     res = api_service.get_messages(
         seconds_history=seconds_history,
-        channel_names=channel_names
+        channel_names=channel_names,
+        after=after
     )
-    return res
+    # the rows are plain JSON types already, skip FastAPI's jsonable_encoder pass
+    return ORJSONResponse(res)
+
+
+@router.get('/twitch/history')
+def get_message_history(start: datetime, end: datetime = None,
+                        channel_names: Optional[List[str]] = Query(None)):
+    """Get older messages from `start` on, straight from the on-disk chat log."""
+    if not api_service.message_log:
+        raise HTTPException(status_code=404, detail='The chat log is not enabled, set api.message-log in the config.')
+    return ORJSONResponse(api_service.get_message_history(start=start, end=end, channel_names=channel_names))
+
+
+@router.get('/twitch/stats')
+async def get_chat_stats(channel_names: Optional[List[str]] = Query(None), top: int = Query(5, ge=0, le=100)):
+    """Get rolling chat activity per channel over the last minute, five minutes and hour."""
+    # async so it runs on the event loop, next to the ingest updating the stats
+    return ORJSONResponse(api_service.get_chat_stats(channel_names=channel_names, top=top))
+
+
+@router.websocket('/twitch/stream')
+async def stream_messages(websocket: WebSocket, channel_names: Optional[List[str]] = Query(None)):
+    """Push new messages to the client as they come in."""
+    await websocket.accept()
+    subscriber = api_service.chat_stream.subscribe(channel_names=channel_names)
+
+    async def watch_disconnect():
+        # stop waiting for messages as soon as the client goes away
+        try:
+            while (await websocket.receive())['type'] != 'websocket.disconnect':
+                pass
+        finally:
+            subscriber.close()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        while True:
+            payload = await subscriber.get()
+            if payload is None:
+                if not watcher.done():
+                    # too slow to keep up, the drop policy disconnected us
+                    await websocket.close(code=1008)
+                break
+            await websocket.send_text(payload)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        watcher.cancel()
+        api_service.chat_stream.unsubscribe(subscriber)
 
 
 @router.post('/user/auth')
@@ -55,9 +140,28 @@ def get_user_info(id: str):
     return api_service.get_rally_account_info(id)
 
 
+def split_fields(fields: Optional[str]):
+    return [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+
+
 @router.get('/user/all_infos')
-def get_user_infos():
-    return api_service.get_all_account_infos()
+def get_user_infos(after: str = None, limit: int = Query(None, ge=1, le=1000), fields: str = None,
+                   username: Optional[List[str]] = Query(None), wallet_id: str = None,
+                   nft_template_id: str = None):
+    """Get all user infos, or one page of them ordered by username when paging.
+
+    `fields` is a comma separated list of the user fields to return.
+    """
+    body = api_service.get_all_account_infos_json(
+        after=after, limit=limit, fields=split_fields(fields), usernames=username,
+        wallet_id=wallet_id, nft_template_id=nft_template_id
+    )
+    return Response(content=body, media_type='application/json')
+
+
+@router.get('/user/by_wallet')
+def get_user_infos_by_wallet(wallet_id: str):
+    return api_service.get_account_infos_by_wallet(wallet_id)
 
 
 @router.post('/rally/tokens')
@@ -71,8 +175,29 @@ def get_nft_templates():
 
 
 @router.get('/rally/all-nfts')
-def get_all_nfts():
-    return api_service.get_all_nfts()
+async def get_all_nfts(refresh: bool = False, nft_template_id: Optional[List[str]] = Query(None),
+                       wallet_id: str = None, after: int = Query(None, ge=0),
+                       limit: int = Query(None, ge=1, le=1000), fields: str = None):
+    """Serve the NFT catalog from memory, `refresh` fetches it from Rally first.
+
+    NFTs are grouped by template id. `fields` is a comma separated list of the NFT
+    fields to return.
+    """
+    if refresh:
+        await api_service.catalog.refresh_now()
+    # filtering and serializing the catalog can take a while, keep it off the event loop
+    body = await run_in_threadpool(
+        api_service.get_all_nfts_json,
+        nft_template_ids=nft_template_id, wallet_id=wallet_id, after=after, limit=limit,
+        fields=split_fields(fields)
+    )
+    return Response(content=body, media_type='application/json')
+
+
+@router.get('/rally/catalog-status')
+def get_catalog_status():
+    """Age and state of the in-memory NFT catalog."""
+    return api_service.get_catalog_status()
 
 
 def main():
@@ -82,16 +207,28 @@ def main():
             title='Jack Bot API',
             description='Something something moon',
             version='0.1',
-            root_path=cfg['nginx-settings']['root_path']
+            root_path=cfg['nginx-settings']['root_path'],
+            default_response_class=ORJSONResponse
         )
     else:
         app = FastAPI(
             title='Jack Bot API',
             description='Something something moon',
-            version='0.1'
+            version='0.1',
+            default_response_class=ORJSONResponse
         )
 
     app.include_router(router)
+    app.add_event_handler('startup', api_service.catalog.start)
+    app.add_event_handler('shutdown', api_service.catalog.stop)
+    app.add_event_handler('shutdown', api_service.osc_router.close)
+    app.add_event_handler('startup', api_service.start_state_follower)
+    app.add_event_handler('shutdown', api_service.stop_state_follower)
+    if api_service.avatar_scheduler:
+        app.add_event_handler('shutdown', api_service.avatar_scheduler.close)
+    if api_service.message_log:
+        app.add_event_handler('startup', api_service.message_log.start)
+        app.add_event_handler('shutdown', api_service.message_log.stop)
     return app
 
 
@@ -1,13 +1,23 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, root_validator
 from typing import List, Optional
 import datetime
 
 
+class OSCTarget(BaseModel):
+    osc_ip: str
+    osc_port: str
+    channel_names: Optional[List[str]]
+    command_types: Optional[List[str]]
+    max_per_second: Optional[float]
+    max_queue: Optional[int]
+
+
 class TwitchBotStatus(BaseModel):
     channel_names: List[str]
     mode: str
-    osc_ip: str
-    osc_port: str
+    osc_ip: Optional[str]
+    osc_port: Optional[str]
+    osc_targets: Optional[List[OSCTarget]]
 
 
 class TwitchMessage(BaseModel):
@@ -20,6 +30,42 @@ class TwitchMessage(BaseModel):
     datetime: Optional[datetime.datetime]
 
 
+class TwitchMessageBatch(BaseModel):
+    messages: List[TwitchMessage]
+
+
+class TwitchMessageColumns(BaseModel):
+    """A batch of messages as one list per field, so it is validated in bulk
+    instead of building a model for every message."""
+    channel_name: List[str]
+    author_name: List[str]
+    author_id: List[str]
+    message_text: List[str]
+    command_type: List[Optional[str]]
+    datetime: List[Optional[datetime.datetime]]
+
+    @root_validator(skip_on_failure=True)
+    def same_lengths(cls, values):
+        lengths = {len(column) for column in values.values()}
+        assert len(lengths) <= 1, 'All columns must have the same length.'
+        return values
+
+    def records(self):
+        """The messages as dicts, like `TwitchMessage.dict()` gives them."""
+        for channel_name, author_name, author_id, message_text, command_type, datetime_ in zip(
+                self.channel_name, self.author_name, self.author_id, self.message_text,
+                self.command_type, self.datetime):
+            yield {
+                'channel_name': channel_name,
+                'author_name': author_name,
+                'author_id': author_id,
+                'message_text': message_text,
+                'is_command': command_type is not None,
+                'command_type': command_type,
+                'datetime': datetime_
+            }
+
+
 class MessageListRequest(BaseModel):
     seconds_history: Optional[int]
     channel_names: Optional[List[str]]
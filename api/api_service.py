@@ -1,12 +1,24 @@
+import asyncio
 import pandas as pd
 import logging
 import os
-import json
 from datetime import datetime, timedelta
-from api.api_model import TwitchBotStatus, TwitchMessage
+from api.api_model import TwitchBotStatus, TwitchMessage, TwitchMessageColumns
+from api.message_store import MessageStore
+from api.chat_stream import ChatBroadcaster
+from api.nft_index import WalletIndex
+from api.catalog_refresher import CatalogRefresher
+from api.user_store import UserStore
+from api.message_log import MessageLog
 from connectors.rally_connector import RallyConnector
 from typing import List
-from pythonosc import udp_client
+from api.osc_sender import OSCLayout, OSCRouter
+from api.avatar_scheduler import AvatarScheduler
+from api.spam_filter import SpamFilter
+from api.chat_stats import ChatStats
+from api.response_cache import ResponseCache, project
+from api.shared_state import create_state
+from itertools import islice
 
 
 class APIService:
@@ -20,35 +32,59 @@ class APIService:
         self.message_show_cols = ['channel_name', 'author_name', 'message_text', 'datetime', 'is_command', 'command_type']
         self.admin_acc = {'twitch_name': cfg}
         self.user_info_path = './data/users.json'
+        self.user_store_path = self.cfg['api'].get('user-store', './data/users.db')
 
         self._init_twitch_status()
         self._init_df()
+        self._init_message_log()
+        self._init_chat_stream()
+        self.spam_filter = SpamFilter.from_config(self.cfg['api'].get('spam-filter'))
+        self.chat_stats = ChatStats(self.cfg['api'].get('stats-windows'))
         self._init_rally_connector()
         self._init_osc()
         self._load_user_data()
-        self.get_all_nfts()
+        self._init_catalog()
 
         self.logger.info('API service ready!')
 
     def _init_twitch_status(self):
-        self.twitch_status = {
+        self._initial_twitch_status = {
             'channel_names': self.cfg['api']['status']['channel-names'],
             'mode': self.cfg['api']['status']['mode'],
             'osc_ip': self.cfg['api']['status']['osc-ip'],
-            'osc_port': self.cfg['api']['status']['osc-port']
+            'osc_port': self.cfg['api']['status']['osc-port'],
+            'osc_targets': [
+                {key.replace('-', '_'): val for key, val in target.items()}
+                for target in self.cfg['api']['status'].get('osc-targets', [])
+            ]
         }
+        self._twitch_status_changed = None
         self.logger.info('Initial Twitch Bot Status:')
-        self.logger.info(self.twitch_status)
+        self.logger.info(self._initial_twitch_status)
 
     def _init_df(self):
         """Initialize our dataframe."""
         col_names = [i for i, v in TwitchMessage.__fields__.items()] + ['timestamp']
+        store_cfg = self.cfg['api'].get('message-store', {})
 
-        self.df_message = pd.DataFrame(columns=col_names)
+        self.message_store = MessageStore(
+            col_names,
+            capacity=store_cfg.get('capacity', 100000),
+            max_age_seconds=store_cfg.get('max-age-seconds'),
+            chunk_size=store_cfg.get('chunk-size', 1024)
+        )
         self.df_user = pd.DataFrame(columns=self.user_df_cols)
 
+        self.state = create_state(self.cfg['api'], self._initial_twitch_status, self.message_store)
+        self._state_status_version = self.state.status_version()
+        self._state_last_message_id = self.state.next_message_id() - 1
+        self.state_poll_interval = self.cfg['api'].get('state', {}).get('poll-interval', 0.25)
+        self._state_task = None
+        self._osc_leader = not self.state.shared
+
         self.logger.info('Dataframes initialized:')
-        self.logger.info(self.df_message)
+        self.logger.info(f'Message store capacity: {self.message_store.capacity}, state backend: '
+                         f'{type(self.state).__name__}')
         self.logger.info(self.df_user)
 
         if 'twitch' in self.cfg:
@@ -60,77 +96,273 @@ class APIService:
                 self.df_user = self.df_user.append(admin_acc, ignore_index=True)
         self.logger.info('Message dataframe initiated.')
 
+    def _init_message_log(self):
+        """Open the on-disk chat log and replay recent history into the message store."""
+        self.message_log = None
+        log_cfg = self.cfg['api'].get('message-log')
+        if not log_cfg:
+            return
+
+        self.message_log = MessageLog(
+            self.message_store.columns,
+            path=log_cfg.get('path', './data/messages'),
+            segment_seconds=log_cfg.get('segment-seconds', 3600),
+            flush_size=log_cfg.get('flush-size', 500),
+            flush_interval=log_cfg.get('flush-interval', 1.0),
+            retention_hours=log_cfg.get('retention-hours')
+        )
+
+        if self.state.shared:
+            # the shared state keeps the messages itself
+            return
+
+        since = datetime.now() - timedelta(hours=log_cfg.get('replay-hours', 1))
+        for message_id, record, timestamp in self.message_log.replay(since=since):
+            if len(self.state) == 0:
+                self.state.skip_to(message_id)
+            elif message_id != self.state.next_message_id():
+                self.logger.warning(f'Chat log skips from {self.state.next_message_id()} to {message_id}.')
+            self.state.append_message(record, timestamp=timestamp)
+
+        last_message_id = self.message_log.last_message_id()
+        if last_message_id is not None and len(self.state) == 0:
+            # nothing recent to replay, but keep message ids unique
+            self.state.skip_to(last_message_id + 1)
+        self._state_last_message_id = self.state.next_message_id() - 1
+        self.logger.info(f'Replayed {len(self.state)} messages from the chat log.')
+
+    def _init_chat_stream(self):
+        stream_cfg = self.cfg['api'].get('stream', {})
+        self.chat_stream = ChatBroadcaster(
+            max_queue=stream_cfg.get('max-queue', 100),
+            drop_policy=stream_cfg.get('drop-policy', 'drop-oldest')
+        )
+        self.logger.info('Chat stream ready.')
+
     def _init_rally_connector(self):
         self.rally = RallyConnector(self.cfg)
+        self.nfts = {}
+        self.wallet_index = WalletIndex()
+        self.nft_responses = ResponseCache()
         self.logger.info('Rally connector ready.')
 
+    def _init_catalog(self):
+        """Serve the last NFT catalog snapshot until the background refresh replaces it."""
+        self.nft_templates = []
+        self.nft_templates_byid = {}
+        self.catalog = CatalogRefresher(
+            self.refresh_catalog,
+            snapshot_path=self.cfg['rally'].get('catalog-snapshot', './data/nft_catalog.json'),
+            interval=self.cfg['rally'].get('refresh-interval', 300),
+            timeout=self.cfg['rally'].get('refresh-timeout', 60)
+        )
+        snapshot = self.catalog.load_snapshot()
+        if snapshot:
+            self._set_catalog(*snapshot)
+
     def _init_osc(self):
+        """Create the OSC router and, when enabled, the avatar scheduler in front of it."""
         self.logger.info('Initializing OSC client...')
-        self.logger.info(f'OSC target IP: {self.twitch_status["osc_ip"]}')
-        self.logger.info(f'OSC target port: {int(self.twitch_status["osc_port"])}')
-        self.osc_client = udp_client.SimpleUDPClient(
-            self.twitch_status['osc_ip'],
-            int(self.twitch_status['osc_port'])
+        osc_cfg = self.cfg['api'].get('osc', {})
+        self.osc_chat_layout = OSCLayout('/twitch-chat', TwitchMessage.__fields__.keys())
+        self.osc_summary_layout = OSCLayout(
+            '/twitch-chat-summary',
+            ['channel_name', 'message_count', 'author_names', 'message_text', 'datetime']
+        )
+        self.osc_router = OSCRouter(
+            max_queue=osc_cfg.get('max-queue', 1000),
+            bundle=osc_cfg.get('bundle', True),
+            tick=osc_cfg.get('tick', 0.01),
+            max_packet_bytes=osc_cfg.get('max-packet-bytes', 8192)
         )
+
+        self.avatar_scheduler = None
+        scheduler_cfg = self.cfg['api'].get('avatar-scheduler')
+        if scheduler_cfg and scheduler_cfg.get('enabled', True):
+            self.avatar_scheduler = AvatarScheduler.from_config(self._dispatch_avatar_event, scheduler_cfg)
+
+        self._set_osc_targets(self.twitch_status)
         self.logger.info('OSC client ready.')
 
+    def _set_osc_targets(self, status: dict):
+        """Point OSC at the status' targets, or at its single osc_ip/osc_port."""
+        targets = status.get('osc_targets')
+        if not targets and status.get('osc_ip'):
+            targets = [{'osc_ip': status['osc_ip'], 'osc_port': status['osc_port']}]
+        if not targets:
+            self.logger.warning('No OSC targets set, chat will not be sent through OSC.')
+        self.osc_router.set_targets(targets or [])
+
+    def _dispatch_avatar_event(self, event, is_summary):
+        layout = self.osc_summary_layout if is_summary else self.osc_chat_layout
+        self.osc_router.send(layout, event)
+
     def _load_user_data(self):
-        """Try to load user auth data."""
-        if os.path.isfile(self.user_info_path):
+        """Open the user store, importing the old JSON user data on first use."""
+        is_new = not os.path.isfile(self.user_store_path)
+        self.users = UserStore(self.user_store_path)
+        self.user_responses = ResponseCache()
+        self._users_data_version = self.users.data_version()
+        if is_new and os.path.isfile(self.user_info_path):
             self.logger.info(f'Found user data in {self.user_info_path}')
-            with open(self.user_info_path, 'r') as f:
-                data = json.load(f)
-            self.user_infos = {d['username']: d for d in data['users']}
-        else:
-            self.user_infos = {}
-
-    def _write_user_data(self):
-        """Persist user data to disk."""
-        infos_nodups = [val for _, val in self.user_infos.items()]
-        with open(self.user_info_path, 'w') as f:
-            json.dump({'users': infos_nodups}, f, indent=4)
-
-    def _load_nft_templates(self):
-        """Load NFT Template info for all known template IDs."""
-        self.nft_templates = self.get_nft_templates()
-        self.nft_templates_byid = {nft['id']: nft for nft in self.nft_templates}
-        self.logger.info(f'Loaded {len(self.nft_templates)} NFT templates.')
+            self.users.import_json(self.user_info_path)
+
+    @property
+    def twitch_status(self) -> dict:
+        return self.state.get_status()
 
     def get_twitch_bot_status(self):
         """Return the settings made for the Twitch bot."""
+        status = self.twitch_status
         self.logger.info('Returning Twitch Bot Status:')
-        self.logger.info(self.twitch_status)
-        return self.twitch_status
+        self.logger.info(status)
+        return status
 
-    def set_twitch_bot_status(self, status: TwitchBotStatus):
-        """Change the settings for the Twitch bot."""
-        self.logger.info('Setting Twitch Bot status:')
-        self.logger.info(status.dict())
-        self.twitch_status = status.dict()
-        self._init_osc()
+    @property
+    def twitch_status_etag(self):
+        """ETag of the current Twitch bot status, changes on every update."""
+        return self.state.status_etag()
 
-    def store_message(self, message: TwitchMessage):
-        """Store the message in the dataframe."""
-        msg_dict = message.dict()
-        msg_dict['timestamp'] = datetime.now()
-        self.logger.debug(f'Storing message: {msg_dict}')
-        self.df_message = self.df_message.append(msg_dict, ignore_index=True)
+    async def read_twitch_bot_status(self):
+        """Return the status and its ETag, without blocking the event loop on shared state."""
+        return await self.state.run(self.state.get_status_with_etag)
 
-        if len(self.df_message) % 100 == 0:
-            self.logger.info(f'API has {len(self.df_message)} messages stored:')
-            self.logger.info(self.df_message[['channel_name', 'author_name', 'message_text']].tail())
-
-    def get_messages(self, seconds_history: int = None, channel_names: List[str] = None):
-        """Return the messages in our dataframe."""
-        sub_df = self.df_message
+    async def set_twitch_bot_status(self, status: TwitchBotStatus):
+        """Change the settings for the Twitch bot. Must run on the event loop."""
+        status = status.dict()
+        self.logger.info('Setting Twitch Bot status:')
+        self.logger.info(status)
+        self._state_status_version = await self.state.run(self.state.set_status, status)
+        self._twitch_status_updated(status)
+
+    def _twitch_status_updated(self, status: dict):
+        if self._twitch_status_changed:
+            self._twitch_status_changed.set()
+            self._twitch_status_changed = None
+        self._set_osc_targets(status)
+
+    async def wait_for_twitch_bot_status(self, etag: str, timeout: float):
+        """Wait until the status no longer matches `etag`, or until the timeout."""
+        _, current_etag = await self.read_twitch_bot_status()
+        if etag != current_etag:
+            return
+        if self._twitch_status_changed is None:
+            self._twitch_status_changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._twitch_status_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def start_state_follower(self):
+        """With shared state, follow what the other API workers write to it."""
+        if self.state.shared:
+            self._state_task = asyncio.create_task(self._follow_state())
+
+    async def stop_state_follower(self):
+        if self._state_task:
+            self._state_task.cancel()
+            self._state_task = None
+        self.state.close()
+
+    async def _follow_state(self):
+        """Pick up status changes and new messages of every worker.
+
+        Each worker only ingests part of the chat, so live subscribers and the chat
+        stats are fed from the shared messages instead of from this worker's ingest.
+        OSC goes out from one worker only, the leader, so the avatar and OSC target
+        rate limits hold for all workers together.
+        """
+        while True:
+            try:
+                await self._poll_state()
+            except Exception as ex:
+                self.logger.error(f'Could not read the shared API state: {ex}')
+            await asyncio.sleep(self.state_poll_interval)
+
+    async def _poll_state(self):
+        version = await self.state.run(self.state.status_version)
+        if version != self._state_status_version:
+            self._state_status_version = version
+            self.logger.info('Twitch Bot status changed by another worker.')
+            self._twitch_status_updated(await self.state.run(self.state.get_status))
+
+        if not self._osc_leader:
+            self._osc_leader = await self.state.run(self.state.claim_leader)
+            if self._osc_leader:
+                self.logger.info('This worker sends the OSC messages of all API workers.')
+
+        records, last_id = await self.state.run(self.state.query_messages, after=self._state_last_message_id)
+        self._state_last_message_id = last_id
+        for record in records:
+            message_id = record.pop('message_id')
+            self.chat_stats.add(record['channel_name'], record['author_name'], record['command_type'])
+            if self.chat_stream.subscribers:
+                live_message = {col: record[col] for col in self.message_show_cols}
+                live_message['message_id'] = message_id
+                self.chat_stream.publish(live_message)
+            if self._osc_leader:
+                await self.send_twitch_message_osc(record)
+
+    @property
+    def df_message(self):
+        """Pandas view of the stored messages."""
+        return self.state.to_frame()
+
+    async def store_messages(self, records: List[dict]) -> List[int]:
+        """Store a batch of messages and return their ids."""
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for record in records:
+                self.logger.debug(f'Storing message: {record}')
+        timestamp = datetime.now()
+        message_ids = await self.state.run(self.state.append_messages, records, timestamp)
+        if self.message_log:
+            for message_id, record in zip(message_ids, records):
+                self.message_log.append(message_id, record, timestamp)
+
+        for i, message_id in enumerate(message_ids):
+            if (message_id + 1) % 100 == 0:
+                self.logger.info(f'API stored message {message_id}, latest ones:')
+                for row in records[max(i - 4, 0):i + 1]:
+                    self.logger.info(f'{row["channel_name"]} - {row["author_name"]}: {row["message_text"]}')
+        return message_ids
+
+    def get_messages(self, seconds_history: int = None, channel_names: List[str] = None, after: int = None):
+        """Return the stored messages.
+
+        Every message carries a monotonic `message_id`. When `after` is given, only messages
+        with a larger id are returned, together with the cursor to pass in the next call.
+        """
+        past = None
         if seconds_history:
             past = datetime.now() - timedelta(seconds=seconds_history)
-            sub_df = sub_df[sub_df['timestamp'] >= past]
+        messages, last_id = self.state.query_messages(
+            since=past,
+            channel_names=channel_names,
+            after=after,
+            columns=self.message_show_cols
+        )
+        if after is None:
+            return messages
+        return {
+            'messages': messages,
+            'next_cursor': last_id
+        }
 
-        if channel_names:
-            sub_df = sub_df[sub_df['channel_name'].isin(channel_names)]
-        sub_df = sub_df[self.message_show_cols]
-        return sub_df.to_dict('records')
+    def get_message_history(self, start: datetime, end: datetime = None,
+                            channel_names: List[str] = None):
+        """Return logged messages between `start` and `end`, read from the on-disk chat log."""
+        table = self.message_log.query(
+            start=start,
+            end=end,
+            channel_names=channel_names,
+            columns=self.message_show_cols + ['message_id']
+        )
+        columns = table.to_pydict()
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def get_chat_stats(self, channel_names: List[str] = None, top: int = 5):
+        """Rolling chat activity per channel and window."""
+        return self.chat_stats.get(channel_names=channel_names, top=top)
 
     def add_user_info(self, info):
         """Store a user's information for NFT check."""
@@ -140,21 +372,14 @@ class APIService:
         if 'rallyNetworkWalletIds' in rally_account_info:
             info['rally'] = rally_account_info
             info = self.get_wallet_nfts(info)
-        self.user_infos[info['username']] = info
-        self._write_user_data()
+        self.users.upsert(info)
+        self.user_responses.invalidate()
 
     def get_wallet_nfts(self, user_info):
-        """Get all the NFTs in a wallet."""
+        """Get all the NFTs in a wallet, from the index built on catalog refresh."""
         self.logger.info(f'Checking NFTs for {user_info}...')
-        self.get_all_nfts(return_value=False)
-        user_info['nfts'] = []
-
-        for nft_template_id, nfts in self.nfts.items():
-            for nft in nfts:
-                if nft['rallyNetworkWalletId'] in user_info['rally']['rallyNetworkWalletIds']:
-                    self.logger.info(f'Found NFT: {nft}')
-                    user_info['nfts'].append(nft)
-
+        user_info['nfts'] = self.wallet_index.get(user_info['rally']['rallyNetworkWalletIds'])
+        self.logger.info(f'Found {len(user_info["nfts"])} NFTs.')
         return user_info
 
     def set_rally_tokens(self, info):
@@ -166,20 +391,62 @@ class APIService:
     def get_nft_templates(self):
         return self.rally.get_nft_templates()
 
-    def get_all_nfts(self, return_value=True):
-        self._load_nft_templates()
+    def refresh_catalog(self):
+        """Fetch the NFT catalog from Rally, bypassing its cache. Blocks on the network."""
         self.logger.info('Getting all NFTs...')
-        nfts = {}
-
-        for key, nft_template in self.nft_templates_byid.items():
-            res = self.rally.get_nft(key)
-            self.logger.debug(f'Found {res}')
-            nfts[key] = res
+        self.rally.invalidate()
+        templates, nfts = self.rally.get_catalog()
+        self._set_catalog(templates, nfts)
+        return templates, nfts
+
+    def _set_catalog(self, templates, nfts):
+        self.nft_templates = templates
+        self.nft_templates_byid = {nft['id']: nft for nft in templates}
+        self.logger.info(f'Loaded {len(self.nft_templates)} NFT templates.')
 
         self.nfts = nfts
+        self.wallet_index.update(nfts)
+        self.nft_responses.invalidate()
+        # filtering users by template goes through the wallet index
+        self.user_responses.invalidate()
         self.logger.info(f'Found {len(nfts)} unique NFTs.')
-        if return_value:
-            return nfts
+
+    def get_all_nfts(self, nft_template_ids: List[str] = None, wallet_id: str = None,
+                     after: int = None, limit: int = None, fields: List[str] = None):
+        """Get the NFTs of every known template from the in-memory catalog, by template id.
+
+        Filter by template ids and the wallet holding them, and keep only `fields` of
+        each NFT. With `after` or `limit`, return one page of NFTs and the next cursor.
+        """
+        nfts = self.wallet_index.by_template(wallet_id) if wallet_id is not None else self.nfts
+        if nft_template_ids:
+            nfts = {id_: nfts[id_] for id_ in nft_template_ids if id_ in nfts}
+        if after is None and limit is None:
+            if not fields:
+                return nfts
+            return {id_: [project(nft, fields) for nft in listing] for id_, listing in nfts.items()}
+
+        after = after or 0
+        listed = ((id_, nft) for id_, listing in nfts.items() if isinstance(listing, list) for nft in listing)
+        page = {}
+        count = 0
+        for id_, nft in islice(listed, after, None if limit is None else after + limit):
+            page.setdefault(id_, []).append(project(nft, fields))
+            count += 1
+        return {'nfts': page, 'next_cursor': after + count if limit is not None and count == limit else None}
+
+    def get_all_nfts_json(self, **query) -> bytes:
+        """`get_all_nfts` serialized, cached until the catalog changes."""
+        return self.nft_responses.get(self._query_key(query), lambda: self.get_all_nfts(**query))
+
+    @staticmethod
+    def _query_key(query: dict):
+        return tuple(sorted((key, tuple(val) if isinstance(val, list) else val) for key, val in query.items()))
+
+    def get_catalog_status(self):
+        status = self.catalog.status()
+        status['nft_templates'] = len(self.nft_templates)
+        return status
 
     def get_rally_account_info(self, id_):
         self.logger.info(f'Retrieving user data for {id_}...')
@@ -187,25 +454,84 @@ class APIService:
         self.logger.info(res)
         return res
 
-    def get_all_account_infos(self):
-        return list(self.user_infos.values())
-
-    def form_osc_message(self, data, message_type='twitch-chat'):
-        if message_type == 'twitch-chat':
-            osc_address = '/twitch-chat'
-            osc_message = [f'{key}:::{val}' for key, val in data.items()]
-
-        return osc_address, osc_message
-
-    async def handle_twitch_message(self, message):
-        """Store the message and send it through OSC."""
-        self.store_message(message)
-        await self.send_twitch_message_osc(message)
-
-    async def send_twitch_message_osc(self, message):
-        self.logger.info(f'Sending Twitch chat OSC: {message}')
-        osc_address, osc_message = self.form_osc_message(
-            message.dict(),
-            message_type='twitch-chat'
-        )
-        self.osc_client.send_message(osc_address, osc_message)
+    def get_all_account_infos(self, after: str = None, limit: int = None, fields: List[str] = None,
+                              usernames: List[str] = None, wallet_id: str = None, nft_template_id: str = None):
+        """Return all user infos. With `after` or `limit`, return one page and the next cursor.
+
+        Filter by usernames, a registered wallet or holding NFTs of a template, and
+        keep only `fields` of each user.
+        """
+        selected = set(usernames) if usernames else None
+        if wallet_id is not None:
+            by_wallet = self.users.usernames_by_wallets([wallet_id])
+            selected = by_wallet if selected is None else selected & by_wallet
+        if nft_template_id is not None:
+            by_template = self.users.usernames_by_wallets(self.wallet_index.wallets(nft_template_id))
+            selected = by_template if selected is None else selected & by_template
+
+        users, next_cursor = self.users.page(after=after, limit=limit, usernames=selected)
+        if fields:
+            users = [project(user, fields) for user in users]
+        if after is None and limit is None:
+            return users
+        return {'users': users, 'next_cursor': next_cursor}
+
+    def get_all_account_infos_json(self, **query) -> bytes:
+        """`get_all_account_infos` serialized, cached until a user or the catalog changes."""
+        data_version = self.users.data_version()
+        if data_version != self._users_data_version:
+            # another worker wrote to the user store
+            self._users_data_version = data_version
+            self.user_responses.invalidate()
+        return self.user_responses.get(self._query_key(query), lambda: self.get_all_account_infos(**query))
+
+    def get_account_infos_by_wallet(self, wallet_id: str):
+        return self.users.get_by_wallet(wallet_id)
+
+    async def handle_twitch_message(self, message: TwitchMessage):
+        await self.handle_chat_records([message.dict()])
+
+    async def handle_twitch_messages(self, messages: List[TwitchMessage]):
+        """Handle a batch of messages in order."""
+        await self.handle_chat_records([message.dict() for message in messages])
+
+    async def handle_twitch_message_columns(self, columns: TwitchMessageColumns):
+        """Handle a column batch of messages in order."""
+        await self.handle_chat_records(list(columns.records()))
+
+    def _is_spam(self, record: dict) -> bool:
+        reason = self.spam_filter.check(record['channel_name'], record['author_name'], record['message_text'],
+                                        is_command=bool(record['is_command']))
+        if reason:
+            self.logger.debug(f'Dropped {reason} message from {record["author_name"]} in {record["channel_name"]}')
+        return bool(reason)
+
+    async def handle_chat_records(self, records: List[dict]):
+        """Store a batch of messages, send them to live chat subscribers and through OSC.
+
+        Each message is converted to a dict once, every step below shares it.
+        """
+        if self.spam_filter:
+            records = [record for record in records if not self._is_spam(record)]
+        if not records:
+            return
+        message_ids = await self.store_messages(records)
+        if self.state.shared:
+            # _follow_state picks the messages up like any other worker's
+            return
+        for message_id, record in zip(message_ids, records):
+            self.chat_stats.add(record['channel_name'], record['author_name'], record['command_type'])
+            if self.chat_stream.subscribers:
+                live_message = self.state.get_message(message_id, self.message_show_cols)
+                live_message['message_id'] = message_id
+                self.chat_stream.publish(live_message)
+            await self.send_twitch_message_osc(record)
+
+    async def send_twitch_message_osc(self, record: dict):
+        """Queue the message for OSC, the sender does the UDP I/O in the background."""
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Sending Twitch chat OSC: {record}')
+        if self.avatar_scheduler:
+            self.avatar_scheduler.submit(record)
+        else:
+            self.osc_router.send(self.osc_chat_layout, record)
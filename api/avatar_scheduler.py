@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Dict
+from api.rate_limit import TokenBucket
+
+
+class _ChannelState:
+    __slots__ = ('bucket', 'queues', 'command_buckets')
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate)
+        self.queues = {}  # command type -> deque of events
+        self.command_buckets = {}  # command type -> TokenBucket
+
+    def pending(self):
+        return any(self.queues.values())
+
+
+class AvatarScheduler:
+    """Throttle and coalesce avatar events before they go out through OSC.
+
+    Events are queued per channel and command type (plain chat is `chat`). Every
+    `tick`, each channel sends what its token buckets allow: one bucket for the
+    channel and one per command type, with command types served in priority order
+    (lowest number first). When `merge_chat` is on and at least `merge_threshold` chat
+    lines are waiting, they go out as one summary event. Queues drop their oldest
+    events when full, so avatar load stays bounded however big the burst.
+    """
+    def __init__(self, dispatch: Callable[[dict, bool], None], tick: float = 0.05,
+                 channel_rate: float = 5, command_rates: Dict[str, float] = None,
+                 default_rate: float = 3, priorities: Dict[str, int] = None,
+                 merge_chat: bool = True, merge_threshold: int = 3, summary_lines: int = 5,
+                 max_queue: int = 100):
+        self.logger = logging.getLogger(__name__)
+        self.dispatch = dispatch  # called with (event, is_summary)
+        self.tick = tick
+        self.channel_rate = channel_rate
+        self.command_rates = command_rates or {}
+        self.default_rate = default_rate
+        self.priorities = priorities or {'donate': 0, 'talk': 1, 'greeting': 1, 'chat': 2}
+        self.merge_chat = merge_chat
+        self.merge_threshold = merge_threshold
+        self.summary_lines = summary_lines
+        self.max_queue = max_queue
+
+        self.dropped = 0
+        self._channels = {}
+        self._wakeup = None
+        self._task = None
+
+    @classmethod
+    def from_config(cls, dispatch, cfg):
+        """Build a scheduler from the `avatar-scheduler` section of the API config."""
+        return cls(
+            dispatch,
+            tick=cfg.get('tick', 0.05),
+            channel_rate=cfg.get('channel-rate', 5),
+            command_rates=cfg.get('command-rates'),
+            default_rate=cfg.get('default-rate', 3),
+            priorities=cfg.get('priorities'),
+            merge_chat=cfg.get('merge-chat', True),
+            merge_threshold=cfg.get('merge-threshold', 3),
+            summary_lines=cfg.get('summary-lines', 5),
+            max_queue=cfg.get('max-queue', 100)
+        )
+
+    def _priority(self, command_type):
+        return self.priorities.get(command_type, max(self.priorities.values(), default=0) + 1)
+
+    def submit(self, event: dict):
+        """Queue an event for its channel. Must run on the event loop."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+        channel_name = event.get('channel_name')
+        command_type = event.get('command_type') or 'chat'
+        state = self._channels.get(channel_name)
+        if state is None:
+            state = self._channels[channel_name] = _ChannelState(self.channel_rate)
+        queue = state.queues.get(command_type)
+        if queue is None:
+            queue = state.queues[command_type] = deque(maxlen=self.max_queue)
+            state.command_buckets[command_type] = TokenBucket(
+                self.command_rates.get(command_type, self.default_rate)
+            )
+            # keep the queues in priority order, so draining can stop at the first match
+            state.queues = dict(sorted(state.queues.items(), key=lambda item: self._priority(item[0])))
+
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+        queue.append(event)
+        self._wakeup.set()
+
+    def _summarize(self, queue: deque) -> dict:
+        """Merge all queued chat lines of a channel into one summary event."""
+        events = list(queue)
+        queue.clear()
+        last = events[-1]
+        authors = list(dict.fromkeys(event.get('author_name') for event in events))
+        return {
+            'channel_name': last.get('channel_name'),
+            'message_count': len(events),
+            'author_names': ','.join(str(author) for author in authors),
+            'message_text': ' | '.join(str(event.get('message_text')) for event in events[-self.summary_lines:]),
+            'datetime': last.get('datetime')
+        }
+
+    def _next_event(self, state: _ChannelState):
+        """Return the next (event, is_summary) the channel may send, or None."""
+        for command_type, queue in state.queues.items():
+            if not queue or not state.command_buckets[command_type].take():
+                continue
+            if command_type == 'chat' and self.merge_chat and len(queue) >= self.merge_threshold:
+                return self._summarize(queue), True
+            return queue.popleft(), False
+        return None
+
+    def _drain(self):
+        for state in self._channels.values():
+            while state.pending() and state.bucket.available() >= 1:
+                next_event = self._next_event(state)
+                if next_event is None:
+                    break
+                state.bucket.take()
+                self.dispatch(*next_event)
+
+    async def _run(self):
+        while True:
+            if not any(state.pending() for state in self._channels.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            try:
+                self._drain()
+            except Exception as ex:
+                self.logger.error(f'Avatar scheduler failed dispatching: {ex!r}')
+            await asyncio.sleep(self.tick)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
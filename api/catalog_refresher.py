@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+
+
+class CatalogRefresher:
+    """Keep the NFT catalog fresh in the background.
+
+    The last catalog snapshot is loaded from disk right away, so the API can serve
+    NFTs without waiting for Rally. A background task then refreshes the catalog
+    every `interval` seconds and writes a new snapshot after each success. A refresh
+    taking longer than `timeout` seconds counts as failed.
+    """
+    def __init__(self, refresh, snapshot_path='./data/nft_catalog.json', interval=300, timeout=60):
+        self.logger = logging.getLogger(__name__)
+        self.refresh = refresh  # blocking callable returning (templates, nfts)
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.timeout = timeout
+
+        self.last_refresh = None
+        self.last_error = None
+        self.source = None
+        self.refreshing = False
+        self._task = None
+        self._refresh = None
+
+    def load_snapshot(self):
+        """Return the (templates, nfts) of the last snapshot, or None if there is none."""
+        if not os.path.isfile(self.snapshot_path):
+            self.logger.info(f'No NFT catalog snapshot in {self.snapshot_path}')
+            return None
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as ex:
+            self.logger.error(f'Could not read NFT catalog snapshot: {ex}')
+            return None
+
+        self.last_refresh = datetime.fromisoformat(data['saved_at'])
+        self.source = 'snapshot'
+        self.logger.info(f'Loaded NFT catalog snapshot from {self.last_refresh}')
+        return data['templates'], data['nfts']
+
+    def write_snapshot(self, templates, nfts):
+        """Atomically replace the snapshot on disk.
+
+        Every writer gets its own temp file, so API workers refreshing at the same time
+        never publish each other's half-written snapshot.
+        """
+        directory, name = os.path.split(os.path.abspath(self.snapshot_path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix=name + '.', suffix='.tmp',
+                                         delete=False) as f:
+            tmp_path = f.name
+            try:
+                json.dump({
+                    'saved_at': self.last_refresh.isoformat(),
+                    'templates': templates,
+                    'nfts': nfts
+                }, f)
+            except Exception:
+                f.close()
+                os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh_now(self):
+        """Refresh the catalog without blocking the event loop.
+
+        Joins the refresh already running, if any, instead of starting another one.
+        """
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._refresh_once())
+        # a cancelled caller must not cancel the refresh other callers wait for
+        await asyncio.shield(self._refresh)
+
+    async def _refresh_once(self):
+        self.refreshing = True
+        loop = asyncio.get_event_loop()
+        try:
+            templates, nfts = await asyncio.wait_for(loop.run_in_executor(None, self.refresh), self.timeout)
+            self.last_refresh = datetime.now()
+            self.last_error = None
+            self.source = 'rally'
+            await loop.run_in_executor(None, self.write_snapshot, templates, nfts)
+        except asyncio.TimeoutError:
+            # the thread still finishes once Rally's request timeouts hit
+            self.last_error = f'Timed out after {self.timeout} seconds'
+            self.logger.error(f'NFT catalog refresh timed out after {self.timeout} seconds')
+        except Exception as ex:
+            self.last_error = repr(ex)
+            self.logger.error(f'NFT catalog refresh failed: {ex!r}')
+        finally:
+            self.refreshing = False
+            self._refresh = None
+
+    async def _run(self):
+        while True:
+            await self.refresh_now()
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self.logger.info(f'NFT catalog refreshes every {self.interval} seconds.')
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self):
+        age = None
+        if self.last_refresh:
+            age = (datetime.now() - self.last_refresh).total_seconds()
+        return {
+            'source': self.source,
+            'last_refresh': self.last_refresh,
+            'age_seconds': age,
+            'refreshing': self.refreshing,
+            'last_error': self.last_error,
+            'interval_seconds': self.interval
+        }
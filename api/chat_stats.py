@@ -0,0 +1,129 @@
+import heapq
+import time
+from collections import Counter, deque
+from typing import Iterable, List
+
+
+class _Second:
+    """Counts of one channel for one second."""
+    __slots__ = ('second', 'messages', 'authors', 'command_types')
+
+    def __init__(self, second: int):
+        self.second = second
+        self.messages = 0
+        self.authors = Counter()
+        self.command_types = Counter()
+
+
+class _Window:
+    """Running totals over the last `seconds` seconds, kept up to date incrementally."""
+    __slots__ = ('seconds', 'buckets', 'messages', 'authors', 'command_types')
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.buckets = deque()
+        self.messages = 0
+        self.authors = Counter()
+        self.command_types = Counter()
+
+    def expire(self, now: int):
+        while self.buckets and self.buckets[0].second <= now - self.seconds:
+            bucket = self.buckets.popleft()
+            self.messages -= bucket.messages
+            self.authors.subtract(bucket.authors)
+            self.command_types.subtract(bucket.command_types)
+            for author in bucket.authors:
+                if self.authors[author] <= 0:
+                    del self.authors[author]
+            for command_type in bucket.command_types:
+                if self.command_types[command_type] <= 0:
+                    del self.command_types[command_type]
+
+    def to_dict(self, top: int):
+        return {
+            'messages': self.messages,
+            'messages_per_second': self.messages / self.seconds,
+            'unique_chatters': len(self.authors),
+            'top_authors': [
+                {'author_name': author, 'messages': count}
+                for author, count in heapq.nlargest(top, self.authors.items(), key=lambda item: item[1])
+            ],
+            'command_types': dict(self.command_types)
+        }
+
+
+class _ChannelStats:
+    __slots__ = ('windows', 'current')
+
+    def __init__(self, windows: Iterable[int]):
+        self.windows = [_Window(seconds) for seconds in windows]
+        self.current = None
+
+    def add(self, second: int, author: str, command_type: str):
+        if self.current is None or self.current.second != second:
+            self.current = _Second(second)
+            for window in self.windows:
+                window.buckets.append(self.current)
+        self.current.messages += 1
+        self.current.authors[author] += 1
+        self.current.command_types[command_type] += 1
+        for window in self.windows:
+            window.messages += 1
+            window.authors[author] += 1
+            window.command_types[command_type] += 1
+
+    def expire(self, now: int):
+        for window in self.windows:
+            window.expire(now)
+        if self.current is not None and self.current.second <= now - self.windows[-1].seconds:
+            self.current = None
+
+    def empty(self):
+        return all(window.messages == 0 for window in self.windows)
+
+
+class ChatStats:
+    """Rolling chat activity per channel: messages per second, unique chatters, top
+    authors and command type counts over the last minute, five minutes and hour.
+
+    Messages are counted in per-second buckets that every window shares, and each
+    window keeps running totals: adding a message is O(1) and a bucket is subtracted
+    once when it falls out of a window. Reading the stats never touches the messages.
+    """
+    WINDOW_NAMES = {60: '1m', 300: '5m', 3600: '1h'}
+
+    def __init__(self, windows: List[int] = None):
+        self.windows = sorted(windows or self.WINDOW_NAMES)
+        self._channels = {}
+
+    @staticmethod
+    def window_name(seconds: int) -> str:
+        return ChatStats.WINDOW_NAMES.get(seconds, f'{seconds}s')
+
+    def add(self, channel_name: str, author_name: str, command_type: str = None, now: float = None):
+        second = int(time.time() if now is None else now)
+        channel = self._channels.get(channel_name)
+        if channel is None:
+            channel = self._channels[channel_name] = _ChannelStats(self.windows)
+        elif channel.current is None or channel.current.second != second:
+            # only a new second can push buckets out of the windows
+            channel.expire(second)
+        channel.add(second, author_name, command_type or 'chat')
+
+    def get(self, channel_names: List[str] = None, top: int = 5, now: float = None) -> dict:
+        """Stats by channel and window name, for all channels unless `channel_names` is given."""
+        second = int(time.time() if now is None else now)
+        stats = {}
+        for channel_name in list(self._channels):
+            channel = self._channels[channel_name]
+            channel.expire(second)
+            if channel.empty():
+                # nobody talked in this channel for the longest window
+                del self._channels[channel_name]
+                continue
+            if channel_names and channel_name not in channel_names:
+                continue
+            stats[channel_name] = {
+                self.window_name(window.seconds): window.to_dict(top) for window in channel.windows
+            }
+        return stats
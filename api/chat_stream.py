@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import orjson
+from typing import List, Optional
+
+
+DROP_POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+
+class ChatSubscriber:
+    """One live chat consumer with its own bounded queue and channel filter."""
+    def __init__(self, channel_names: Optional[List[str]] = None, max_queue: int = 100,
+                 drop_policy: str = 'drop-oldest'):
+        assert drop_policy in DROP_POLICIES, f'Unknown drop policy {drop_policy}, use one of {DROP_POLICIES}'
+        self.channel_names = set(channel_names) if channel_names else None
+        self.drop_policy = drop_policy
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, message: dict) -> bool:
+        return self.channel_names is None or message['channel_name'] in self.channel_names
+
+    def offer(self, payload: str):
+        """Queue a payload without blocking, applying the drop policy when full."""
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(payload)
+            return
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+        if self.drop_policy == 'drop-oldest':
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+        elif self.drop_policy == 'disconnect':
+            self.close()
+
+    def close(self):
+        """Stop the subscriber; a pending `get` returns None."""
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self) -> Optional[str]:
+        return await self.queue.get()
+
+
+class ChatBroadcaster:
+    """Fan out new chat messages to live subscribers.
+
+    Each message is serialized once, however many subscribers receive it. Slow
+    subscribers never block the publisher: their queue is bounded and overflow is
+    handled by their drop policy.
+    """
+    def __init__(self, max_queue: int = 100, drop_policy: str = 'drop-oldest'):
+        self.logger = logging.getLogger(__name__)
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.subscribers = set()
+
+    def subscribe(self, channel_names: Optional[List[str]] = None) -> ChatSubscriber:
+        subscriber = ChatSubscriber(
+            channel_names=channel_names,
+            max_queue=self.max_queue,
+            drop_policy=self.drop_policy
+        )
+        self.subscribers.add(subscriber)
+        self.logger.info(f'New chat stream subscriber for {channel_names or "all channels"}, '
+                         f'{len(self.subscribers)} subscribers.')
+        return subscriber
+
+    def unsubscribe(self, subscriber: ChatSubscriber):
+        self.subscribers.discard(subscriber)
+        if subscriber.dropped:
+            self.logger.warning(f'Chat stream subscriber dropped {subscriber.dropped} messages.')
+        self.logger.info(f'Chat stream subscriber left, {len(self.subscribers)} subscribers.')
+
+    def publish(self, message: dict):
+        """Send a message to every interested subscriber. Must run on the event loop."""
+        payload = None
+        for subscriber in self.subscribers:
+            if not subscriber.wants(message):
+                continue
+            if payload is None:
+                payload = orjson.dumps(message, default=str).decode()
+            subscriber.offer(payload)
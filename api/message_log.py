@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterable, List
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+COLUMN_TYPES = {
+    'message_id': pa.int64(),
+    'timestamp': pa.timestamp('us'),
+    'datetime': pa.timestamp('us'),
+    'is_command': pa.bool_(),
+}
+
+
+class MessageLog:
+    """Append-only on-disk chat log in time-partitioned Arrow IPC segments.
+
+    Messages are buffered and written as one record batch per flush, followed by a
+    single fsync. The event loop only hands the full buffer over, the writing and the
+    fsync happen on the log's own thread, one flush after the other. A new segment
+    starts for every `segment_seconds` time partition and on every restart, so a
+    segment is never reopened for writing. Segments are read
+    back through memory maps, both to replay recent history into the message store
+    and to query older history.
+    """
+    def __init__(self, columns: Iterable[str], path='./data/messages', segment_seconds=3600,
+                 flush_size=500, flush_interval=1.0, retention_hours=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retention = timedelta(hours=retention_hours) if retention_hours else None
+
+        names = ['message_id'] + [col for col in columns if col != 'message_id']
+        self.schema = pa.schema([(name, COLUMN_TYPES.get(name, pa.string())) for name in names])
+        self._buffer = {name: [] for name in self.schema.names}
+        self._buffer_partition = None
+        self._last_flush = time.monotonic()
+
+        self._file = None
+        self._writer = None
+        self._partition = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='message-log')
+        os.makedirs(self.path, exist_ok=True)
+
+    def _partition_of(self, timestamp: datetime) -> int:
+        epoch = int(timestamp.timestamp())
+        return epoch - epoch % self.segment_seconds
+
+    def _segments(self):
+        """Return (partition start, path) of every segment, oldest first."""
+        segments = []
+        for name in os.listdir(self.path):
+            if not name.startswith('messages-') or not name.endswith('.arrows'):
+                continue
+            partition, first_id = name[len('messages-'):-len('.arrows')].split('-')
+            segments.append((int(partition), int(first_id), os.path.join(self.path, name)))
+        return [(partition, path) for partition, _, path in sorted(segments)]
+
+    def append(self, message_id: int, record: dict, timestamp: datetime):
+        """Buffer one message, flushing when the buffer is full or the partition changes."""
+        partition = self._partition_of(timestamp)
+        if self._buffer_partition is not None and partition != self._buffer_partition:
+            self.flush()
+        self._buffer_partition = partition
+
+        for name in self.schema.names:
+            self._buffer[name].append(record.get(name))
+        self._buffer['message_id'][-1] = message_id
+        self._buffer['timestamp'][-1] = timestamp
+
+        if (len(self._buffer['message_id']) >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _open_segment(self, partition: int, first_id: int):
+        self._close_segment()
+        path = os.path.join(self.path, f'messages-{partition}-{first_id}.arrows')
+        self._file = open(path, 'wb')
+        self._writer = pa.ipc.new_stream(self._file, self.schema)
+        self._partition = partition
+        self.logger.info(f'Writing chat log segment {path}')
+
+    def _close_segment(self):
+        if self._writer:
+            self._writer.close()
+            self._file.close()
+        self._writer = None
+        self._file = None
+
+    def flush(self):
+        """Hand the buffered messages to the log thread, which writes and fsyncs them."""
+        self._last_flush = time.monotonic()
+        if not self._buffer['message_id']:
+            return None
+        buffer, self._buffer = self._buffer, {name: [] for name in self.schema.names}
+        return self._executor.submit(self._write, buffer, self._buffer_partition)
+
+    def _write(self, buffer: dict, partition: int):
+        """Write one buffer as a record batch and fsync it. Runs on the log thread."""
+        try:
+            if self._writer is None or partition != self._partition:
+                self._open_segment(partition, buffer['message_id'][0])
+            batch = pa.record_batch(
+                [pa.array(buffer[field.name], type=field.type) for field in self.schema],
+                schema=self.schema
+            )
+            self._writer.write_batch(batch)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception as ex:
+            self.logger.error(f'Could not write {len(buffer["message_id"])} messages to the chat log: {ex!r}')
+
+    def _read_segment(self, path: str):
+        """Yield the record batches of one segment, stopping at a torn tail."""
+        with pa.memory_map(path) as source:
+            try:
+                for batch in pa.ipc.open_stream(source):
+                    yield batch
+            except (pa.ArrowInvalid, OSError) as ex:
+                self.logger.warning(f'Chat log segment {path} ends early: {ex}')
+
+    def _segments_between(self, start: datetime = None, end: datetime = None):
+        for partition, path in self._segments():
+            if start and partition + self.segment_seconds <= start.timestamp():
+                continue
+            if end and partition > end.timestamp():
+                continue
+            yield path
+
+    def replay(self, since: datetime = None):
+        """Yield (message id, record, timestamp) of the logged messages from `since` onwards."""
+        for path in self._segments_between(start=since):
+            for batch in self._read_segment(path):
+                columns = batch.to_pydict()
+                for i, timestamp in enumerate(columns['timestamp']):
+                    if since and timestamp < since:
+                        continue
+                    record = {name: values[i] for name, values in columns.items()}
+                    yield record['message_id'], record, timestamp
+
+    def query(self, start: datetime, end: datetime = None, channel_names: List[str] = None,
+              columns: List[str] = None) -> pa.Table:
+        """Read logged messages between `start` and `end` straight from the segments.
+
+        `start` is required, so a query only maps the segments it needs rather than the
+        whole retention period.
+        """
+        batches = [
+            batch for path in self._segments_between(start=start, end=end)
+            for batch in self._read_segment(path)
+        ]
+        table = pa.Table.from_batches(batches, schema=self.schema)
+        table = table.filter(pc.greater_equal(table['timestamp'], pa.scalar(start, type=pa.timestamp('us'))))
+        if end:
+            table = table.filter(pc.less(table['timestamp'], pa.scalar(end, type=pa.timestamp('us'))))
+        if channel_names:
+            table = table.filter(pc.is_in(table['channel_name'], value_set=pa.array(channel_names)))
+        if columns:
+            table = table.select(columns)
+        return table
+
+    def last_message_id(self):
+        """Return the id of the last logged message, or None."""
+        for _, path in reversed(self._segments()):
+            last = None
+            for batch in self._read_segment(path):
+                if batch.num_rows:
+                    last = batch.column(0)[-1].as_py()
+            if last is not None:
+                return last
+        return None
+
+    def drop_expired(self):
+        """Delete segments that are entirely past the retention period."""
+        if not self.retention:
+            return
+        oldest_allowed = (datetime.now() - self.retention).timestamp()
+        for partition, path in self._segments():
+            if partition + self.segment_seconds < oldest_allowed and partition != self._partition:
+                os.remove(path)
+                self.logger.info(f'Removed expired chat log segment {path}')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+                self._executor.submit(self.drop_expired)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        self._executor.submit(self._close_segment)
+        # waits for the writes still queued
+        await asyncio.get_event_loop().run_in_executor(None, self._executor.shutdown)
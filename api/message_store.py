@@ -0,0 +1,232 @@
+import copy
+import heapq
+import logging
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+
+class _ColumnIndex:
+    """Positions and timestamps of the rows sharing one value of an indexed column."""
+    __slots__ = ('positions', 'timestamps', 'start')
+
+    def __init__(self):
+        self.positions = []
+        self.timestamps = []
+        self.start = 0  # entries before this offset are evicted
+
+    def __len__(self):
+        return len(self.positions) - self.start
+
+    def add(self, position: int, timestamp: datetime):
+        self.positions.append(position)
+        self.timestamps.append(timestamp)
+
+    def trim(self, head: int):
+        """Forget entries for positions older than `head`."""
+        self.start = bisect_left(self.positions, head, lo=self.start)
+        if self.start > 1024 and self.start * 2 > len(self.positions):
+            del self.positions[:self.start]
+            del self.timestamps[:self.start]
+            self.start = 0
+
+    def positions_since(self, since: datetime = None, start_position: int = None) -> List[int]:
+        start = self.start
+        if start_position is not None:
+            start = bisect_left(self.positions, start_position, lo=start)
+        if since is not None:
+            start = bisect_left(self.timestamps, since, lo=start)
+        return self.positions[start:]
+
+
+class MessageStore:
+    """Append-optimized columnar store for chat messages.
+
+    Rows are kept in fixed-size chunks of preallocated column lists, so an append
+    never copies the rows already stored. Every row gets a monotonic position; the
+    oldest rows are evicted once the store exceeds `capacity` rows or once they are
+    older than `max_age_seconds`.
+
+    Timestamps are kept monotonic and rows are indexed by `index_column`, so queries
+    for a time window and a set of channels are answered by binary search and cost
+    in proportion to the number of rows returned.
+    """
+    def __init__(self, columns: Iterable[str], capacity: int = 100000,
+                 max_age_seconds: Optional[float] = None, chunk_size: int = 1024,
+                 index_column: str = 'channel_name'):
+        assert capacity > 0, 'Message store capacity must be positive.'
+        assert chunk_size > 0, 'Message store chunk size must be positive.'
+        self.logger = logging.getLogger(__name__)
+        self.columns = list(columns)
+        if 'timestamp' not in self.columns:
+            self.columns.append('timestamp')
+        self.capacity = capacity
+        self.max_age = timedelta(seconds=max_age_seconds) if max_age_seconds else None
+        self.chunk_size = chunk_size
+        self.index_column = index_column
+
+        self._index = {}
+        self._last_timestamp = None
+        self._chunks = deque()
+        self._base = 0  # position of the first row in the first chunk
+        self._head = 0  # position of the oldest live row
+        self._next = 0  # position the next appended row will get
+
+    def __len__(self):
+        return self._next - self._head
+
+    @property
+    def first_position(self):
+        return self._head
+
+    @property
+    def next_position(self):
+        return self._next
+
+    def skip_to(self, position: int):
+        """Make the next appended row get `position`, e.g. to continue ids after a restart."""
+        assert len(self) == 0, 'Can only skip positions in an empty message store.'
+        self._chunks.clear()
+        self._index.clear()
+        self._base = self._head = self._next = position
+
+    def view(self) -> 'MessageStore':
+        """Return a read-only copy of the live rows, for reading them while others append.
+
+        Only the chunk list is copied: rows never change once written and eviction only
+        drops whole chunks, so the copy keeps reading the rows as they were. The copy
+        has no column index, read it by position.
+        """
+        view = copy.copy(self)
+        view._chunks = deque(self._chunks)
+        view._index = {}
+        return view
+
+    def _new_chunk(self):
+        return {col: [None] * self.chunk_size for col in self.columns}
+
+    def append(self, record: dict, timestamp: datetime = None) -> int:
+        """Store one message and return its position."""
+        if timestamp is None:
+            timestamp = datetime.now()
+        if self._last_timestamp is not None and timestamp < self._last_timestamp:
+            # keep timestamps monotonic so binary search stays valid
+            timestamp = self._last_timestamp
+        self._last_timestamp = timestamp
+
+        offset = (self._next - self._base) % self.chunk_size
+        if offset == 0:
+            self._chunks.append(self._new_chunk())
+        chunk = self._chunks[-1]
+        for col in self.columns:
+            chunk[col][offset] = record.get(col)
+        chunk['timestamp'][offset] = timestamp
+
+        position = self._next
+        self._next += 1
+        key = chunk[self.index_column][offset]
+        if key not in self._index:
+            self._index[key] = _ColumnIndex()
+        self._index[key].add(position, timestamp)
+        self._evict(timestamp)
+        return position
+
+    def _evict(self, now: datetime):
+        """Drop rows over capacity or past their maximum age."""
+        head = max(self._head, self._next - self.capacity)
+        if self.max_age:
+            oldest_allowed = now - self.max_age
+            while head < self._next and self._get(head, 'timestamp') < oldest_allowed:
+                head += 1
+        self._head = head
+
+        # release whole chunks once every row in them is evicted
+        released = False
+        while self._head - self._base >= self.chunk_size:
+            self._chunks.popleft()
+            self._base += self.chunk_size
+            released = True
+
+        if released:
+            self._trim_index()
+
+    def _trim_index(self):
+        """Drop evicted rows from the column index."""
+        for key in list(self._index):
+            self._index[key].trim(self._head)
+            if len(self._index[key]) == 0:
+                del self._index[key]
+
+    def _search_time(self, since: datetime) -> int:
+        """Return the first live position with a timestamp at or after `since`."""
+        lo, hi = self._head, self._next
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get(mid, 'timestamp') < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _get(self, position: int, col: str):
+        chunk_idx, offset = divmod(position - self._base, self.chunk_size)
+        return self._chunks[chunk_idx][col][offset]
+
+    def row(self, position: int, columns: List[str] = None) -> dict:
+        """Return the row at a position as a dict."""
+        chunk_idx, offset = divmod(position - self._base, self.chunk_size)
+        chunk = self._chunks[chunk_idx]
+        return {col: chunk[col][offset] for col in columns or self.columns}
+
+    def iter_rows(self, start: int = None, columns: List[str] = None):
+        """Yield (position, row) pairs from `start` (or the oldest row) onwards."""
+        start = self._head if start is None else max(start, self._head)
+        for position in range(start, self._next):
+            yield position, self.row(position, columns)
+
+    def index_keys(self) -> List:
+        """Return the values of the indexed column that have live rows."""
+        return [key for key, idx in self._index.items() if len(idx) > 0]
+
+    def positions(self, since: datetime = None, keys: List = None, start: int = None) -> Iterable[int]:
+        """Return the live positions from `since` and `start` onwards, optionally for some index keys only."""
+        if keys is None:
+            first = self._head if since is None else self._search_time(since)
+            if start is not None:
+                first = max(first, start)
+            return range(first, self._next)
+
+        per_key = []
+        for key in set(keys):
+            idx = self._index.get(key)
+            if idx is None:
+                continue
+            idx.trim(self._head)
+            per_key.append(idx.positions_since(since, start_position=start))
+
+        if len(per_key) == 1:
+            return per_key[0]
+        return heapq.merge(*per_key)
+
+    def query(self, since: datetime = None, keys: List = None, columns: List[str] = None, start: int = None):
+        """Yield (position, row) pairs from `since` and `start` onwards, optionally for some index keys only."""
+        for position in self.positions(since=since, keys=keys, start=start):
+            yield position, self.row(position, columns)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the live rows as a pandas DataFrame."""
+        if len(self) == 0:
+            return pd.DataFrame(columns=self.columns)
+
+        start = self._head - self._base
+        stop = self._next - self._base
+        data = {}
+        for col in self.columns:
+            values = []
+            for chunk in self._chunks:
+                values.extend(chunk[col])
+            data[col] = values[start:stop]
+        return pd.DataFrame(data, columns=self.columns)
@@ -0,0 +1,85 @@
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+
+class WalletIndex:
+    """Inverted index from `rallyNetworkWalletId` to the NFTs held by that wallet.
+
+    The index is kept per NFT template, so refreshing one template's listing only
+    touches the wallets that appear in the old or new listing of that template.
+    Catalog refreshes update it from a worker thread, so changes and lookups hold a
+    lock and lookups return copies.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._by_wallet = defaultdict(dict)  # wallet id -> {template id: [nfts]}
+        self._wallets_by_template = {}  # template id -> set of wallet ids
+        self._listings = {}  # template id -> listing the index was built from
+
+    def __len__(self):
+        return len(self._by_wallet)
+
+    def set_template(self, nft_template_id: str, nfts: List[dict]):
+        """Replace everything we know about one template's NFTs."""
+        with self._lock:
+            self._set_template(nft_template_id, nfts)
+
+    def _set_template(self, nft_template_id: str, nfts: List[dict]):
+        self._remove_template(nft_template_id)
+
+        wallets = set()
+        for nft in nfts:
+            if not isinstance(nft, dict) or nft.get('rallyNetworkWalletId') is None:
+                # skip error payloads and NFTs without a wallet
+                continue
+            wallet_id = nft['rallyNetworkWalletId']
+            self._by_wallet[wallet_id].setdefault(nft_template_id, []).append(nft)
+            wallets.add(wallet_id)
+        self._wallets_by_template[nft_template_id] = wallets
+        self._listings[nft_template_id] = nfts
+
+    def remove_template(self, nft_template_id: str):
+        with self._lock:
+            self._remove_template(nft_template_id)
+
+    def _remove_template(self, nft_template_id: str):
+        self._listings.pop(nft_template_id, None)
+        for wallet_id in self._wallets_by_template.pop(nft_template_id, ()):
+            held = self._by_wallet[wallet_id]
+            held.pop(nft_template_id, None)
+            if not held:
+                del self._by_wallet[wallet_id]
+
+    def update(self, nfts_by_template: Dict[str, List[dict]]):
+        """Apply a catalog refresh, only reindexing templates whose listing changed."""
+        with self._lock:
+            for nft_template_id in set(self._wallets_by_template) - set(nfts_by_template):
+                self._remove_template(nft_template_id)
+            for nft_template_id, nfts in nfts_by_template.items():
+                listing = self._listings.get(nft_template_id)
+                if listing is nfts or listing == nfts:
+                    continue
+                self._set_template(nft_template_id, nfts)
+        self.logger.info(f'Wallet index covers {len(self._by_wallet)} wallets.')
+
+    def wallets(self, nft_template_id: str) -> Set[str]:
+        """Return the wallets holding NFTs of the template."""
+        with self._lock:
+            return set(self._wallets_by_template.get(nft_template_id, ()))
+
+    def by_template(self, wallet_id: str) -> Dict[str, List[dict]]:
+        """Return the NFTs held by the wallet, by template id."""
+        with self._lock:
+            return dict(self._by_wallet.get(wallet_id, {}))
+
+    def get(self, wallet_ids: Iterable[str]) -> List[dict]:
+        """Return the NFTs held by any of the wallets."""
+        nfts = []
+        with self._lock:
+            for wallet_id in wallet_ids:
+                for held in self._by_wallet.get(wallet_id, {}).values():
+                    nfts.extend(held)
+        return nfts
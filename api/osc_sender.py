@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import struct
+from collections import deque
+from typing import Iterable, List
+from api.rate_limit import TokenBucket
+
+
+BUNDLE_HEADER = b'#bundle\x00' + struct.pack('>Q', 1)  # time tag 1 means "immediately"
+
+
+def osc_string(data: bytes) -> bytes:
+    """Null-terminate and pad to a multiple of 4 bytes, as OSC strings require."""
+    data += b'\x00'
+    return data + b'\x00' * (-len(data) % 4)
+
+
+class OSCLayout:
+    """Precompiled layout for OSC messages of `key:::value` string arguments.
+
+    The address, the type tag string and every `key:::` prefix are encoded once, so
+    encoding a message only has to encode and pad its values.
+    """
+    def __init__(self, address: str, keys: Iterable[str]):
+        self.address = address
+        self.keys = list(keys)
+        self._header = osc_string(address.encode()) + osc_string((',' + 's' * len(self.keys)).encode())
+        self._prefixes = [f'{key}:::'.encode() for key in self.keys]
+
+    def encode(self, data: dict) -> bytes:
+        parts = [self._header]
+        for key, prefix in zip(self.keys, self._prefixes):
+            parts.append(osc_string(prefix + str(data.get(key)).encode()))
+        return b''.join(parts)
+
+
+def encode_bundle(datagrams: List[bytes]) -> bytes:
+    return BUNDLE_HEADER + b''.join(struct.pack('>i', len(datagram)) + datagram for datagram in datagrams)
+
+
+class _OSCProtocol(asyncio.DatagramProtocol):
+    def __init__(self, logger):
+        self.logger = logger
+
+    def error_received(self, exc):
+        self.logger.warning(f'OSC send error: {exc}')
+
+
+class OSCSender:
+    """Send encoded OSC messages over an asyncio datagram transport.
+
+    `send` only queues a packet, so callers never wait on UDP I/O. A background task
+    drains the queue; with `bundle` enabled, the messages queued during one `tick` go
+    out together as OSC bundles of at most `max_packet_bytes`. With `max_per_second`
+    set, messages are held back to stay under that rate. When the queue is full the
+    oldest message is dropped.
+    """
+    def __init__(self, ip: str, port: int, max_queue: int = 1000, bundle: bool = True,
+                 tick: float = 0.01, max_packet_bytes: int = 8192, max_per_second: float = None):
+        self.logger = logging.getLogger(__name__)
+        self.ip = ip
+        self.port = int(port)
+        self.bundle = bundle
+        self.tick = tick
+        self.max_packet_bytes = max_packet_bytes
+        self.rate_limit = TokenBucket(max_per_second) if max_per_second else None
+
+        self.dropped = 0
+        self.sent = 0
+        self.max_queue = max_queue
+        self._queue = deque(maxlen=max_queue)
+        self._transport = None
+        self._wakeup = None
+        self._task = None
+
+    def send(self, datagram: bytes):
+        """Queue an encoded message. Must run on the event loop."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                self.logger.warning(f'OSC queue full, dropped {self.dropped} messages so far.')
+        self._queue.append(datagram)
+        self._wakeup.set()
+
+    def take_queued(self) -> List[bytes]:
+        """Remove and return the messages not sent yet."""
+        queued = list(self._queue)
+        self._queue.clear()
+        return queued
+
+    async def _ensure_transport(self):
+        if self._transport is None:
+            loop = asyncio.get_event_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _OSCProtocol(self.logger),
+                remote_addr=(self.ip, self.port)
+            )
+
+    def _packets(self, max_messages: int):
+        """Drain up to `max_messages` messages from the queue into packets to send."""
+        if not self.bundle:
+            while self._queue and max_messages > 0:
+                max_messages -= 1
+                yield self._queue.popleft()
+            return
+
+        while self._queue and max_messages > 0:
+            datagrams = [self._queue.popleft()]
+            size = len(BUNDLE_HEADER) + 4 + len(datagrams[0])
+            while (self._queue and len(datagrams) < max_messages
+                   and size + 4 + len(self._queue[0]) <= self.max_packet_bytes):
+                size += 4 + len(self._queue[0])
+                datagrams.append(self._queue.popleft())
+            max_messages -= len(datagrams)
+            yield encode_bundle(datagrams) if len(datagrams) > 1 else datagrams[0]
+
+    def _allowed_messages(self):
+        if self.rate_limit is None:
+            return len(self._queue)
+        allowed = min(len(self._queue), int(self.rate_limit.available()))
+        self.rate_limit.take(allowed)
+        return allowed
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if self.bundle and self.tick:
+                # collect whatever else arrives during this tick
+                await asyncio.sleep(self.tick)
+            if self.rate_limit and self.rate_limit.available() < 1:
+                await asyncio.sleep(self.rate_limit.wait_time())
+                continue
+            try:
+                await self._ensure_transport()
+                for packet in self._packets(self._allowed_messages()):
+                    self._transport.sendto(packet)
+                    self.sent += 1
+            except Exception as ex:
+                # keep the sender alive, send() would never restart it
+                self.logger.error(f'Failed sending OSC to {self.ip}:{self.port}: {ex!r}')
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+
+class OSCRouter:
+    """Fan chat messages out to several OSC targets.
+
+    Each target has its own sender, so its own queue, rate limit and drop-oldest
+    backpressure, plus optional channel and command type filters. A message is
+    encoded once, however many targets receive it. Plain chat has command type `chat`.
+    """
+    def __init__(self, max_queue: int = 1000, bundle: bool = True, tick: float = 0.01,
+                 max_packet_bytes: int = 8192):
+        self.logger = logging.getLogger(__name__)
+        self.defaults = {
+            'max_queue': max_queue,
+            'bundle': bundle,
+            'tick': tick,
+            'max_packet_bytes': max_packet_bytes
+        }
+        self.targets = []  # (sender, channel names, command types)
+
+    def set_targets(self, targets: List[dict]):
+        """Replace the targets. Must run on the event loop.
+
+        Senders of unchanged targets are kept, with their queue and rate limit state.
+        """
+        senders = {(sender.ip, sender.port): sender for sender, _, _ in self.targets}
+        new_targets = []
+        for target in targets:
+            key = (target['osc_ip'], int(target['osc_port']))
+            sender = senders.pop(key, None)
+            max_queue = target.get('max_queue') or self.defaults['max_queue']
+            max_per_second = target.get('max_per_second')
+            if sender is None:
+                sender = self._new_sender(target, max_queue, max_per_second)
+            elif sender.max_queue != max_queue:
+                # the queue size is fixed, move what is queued over to a new sender
+                old_sender = sender
+                sender = self._new_sender(target, max_queue, max_per_second)
+                for datagram in old_sender.take_queued():
+                    sender.send(datagram)
+                asyncio.ensure_future(old_sender.close())
+            elif (sender.rate_limit.rate if sender.rate_limit else None) != max_per_second:
+                # a fresh bucket starts full, only swap it when the rate changed
+                sender.rate_limit = TokenBucket(max_per_second) if max_per_second else None
+            new_targets.append((
+                sender,
+                set(target['channel_names']) if target.get('channel_names') else None,
+                set(target['command_types']) if target.get('command_types') else None
+            ))
+            self.logger.info(f'OSC target {key[0]}:{key[1]} for channels {target.get("channel_names") or "all"}, '
+                             f'commands {target.get("command_types") or "all"}, '
+                             f'max {max_per_second or "unlimited"} messages per second.')
+
+        for sender in senders.values():
+            asyncio.ensure_future(sender.close())
+        self.targets = new_targets
+
+    def _new_sender(self, target: dict, max_queue: int, max_per_second: float = None) -> OSCSender:
+        return OSCSender(
+            target['osc_ip'],
+            target['osc_port'],
+            max_queue=max_queue,
+            bundle=self.defaults['bundle'],
+            tick=self.defaults['tick'],
+            max_packet_bytes=self.defaults['max_packet_bytes'],
+            max_per_second=max_per_second
+        )
+
+    def send(self, layout: OSCLayout, message: dict):
+        """Queue a message for every target that wants it, encoding it at most once."""
+        command_type = message.get('command_type') or 'chat'
+        datagram = None
+        for sender, channel_names, command_types in self.targets:
+            if channel_names is not None and message.get('channel_name') not in channel_names:
+                continue
+            if command_types is not None and command_type not in command_types:
+                continue
+            if datagram is None:
+                datagram = layout.encode(message)
+            sender.send(datagram)
+
+    async def close(self):
+        for sender, _, _ in self.targets:
+            await sender.close()
@@ -0,0 +1,35 @@
+import time
+
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` tokens per second, bursts of up to `burst`."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float = None):
+        assert rate > 0, 'Token bucket rate must be positive.'
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, now: float = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def take(self, tokens: float = 1, now: float = None) -> bool:
+        """Take tokens if there are enough, return whether we did."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens: float = 1, now: float = None) -> float:
+        """Seconds until `tokens` tokens are available."""
+        self._refill(time.monotonic() if now is None else now)
+        return max(0.0, (tokens - self.tokens) / self.rate)
@@ -0,0 +1,49 @@
+import threading
+import orjson
+from collections import OrderedDict
+
+
+def project(item: dict, fields):
+    """Keep only the requested fields of a record, all of them when `fields` is empty."""
+    if not fields or not isinstance(item, dict):
+        return item
+    return {field: item[field] for field in fields if field in item}
+
+
+class ResponseCache:
+    """Serialized JSON responses, kept until the data behind them changes.
+
+    Entries are keyed by the request parameters, so every distinct query is encoded
+    once and then served as bytes. Call `invalidate` whenever the data changes.
+    At most `max_entries` queries are kept, the least recently used go first. Safe to
+    share between the event loop and the threadpool running sync routes.
+    """
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key, build) -> bytes:
+        """Return the cached bytes for `key`, serializing what `build()` returns when missing."""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                return body
+            generation = self._generation
+        # build outside the lock, two threads missing the same key both build it
+        body = orjson.dumps(build(), default=str)
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while building, don't keep what may be stale
+                return body
+            self._entries[key] = body
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
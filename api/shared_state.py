@@ -0,0 +1,335 @@
+import asyncio
+import fcntl
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+import pandas as pd
+from api.message_store import MessageStore
+
+
+class LocalState:
+    """Bot status and recent messages of a single API process.
+
+    Ingest runs on the event loop while sync routes run in FastAPI's threadpool, so
+    the status and the messages each have their own lock. Reads only pick the rows
+    under the lock and build them after releasing it, so a large read does not hold
+    up ingest.
+    """
+    shared = False
+
+    def __init__(self, status: dict, message_store: MessageStore):
+        self.logger = logging.getLogger(__name__)
+        self.message_store = message_store
+        self._status = status
+        self._status_version = 0
+        self._epoch = int(time.time())  # keeps ETags unique across restarts
+        self._status_lock = threading.Lock()
+        self._message_lock = threading.Lock()
+
+    async def run(self, func, *args, **kwargs):
+        """Run a state method from the event loop, in memory it is fast enough to call inline."""
+        return func(*args, **kwargs)
+
+    def claim_leader(self) -> bool:
+        """A single process is always the one sending OSC."""
+        return True
+
+    def get_status(self) -> dict:
+        with self._status_lock:
+            return dict(self._status)
+
+    def get_status_with_etag(self):
+        with self._status_lock:
+            return dict(self._status), f'"{self._epoch}-{self._status_version}"'
+
+    def set_status(self, status: dict) -> int:
+        """Replace the status and return its new version."""
+        with self._status_lock:
+            self._status = status
+            self._status_version += 1
+            return self._status_version
+
+    def status_version(self) -> int:
+        return self._status_version
+
+    def status_etag(self) -> str:
+        return f'"{self._epoch}-{self._status_version}"'
+
+    def __len__(self):
+        return len(self.message_store)
+
+    def skip_to(self, message_id: int):
+        with self._message_lock:
+            self.message_store.skip_to(message_id)
+
+    def next_message_id(self) -> int:
+        return self.message_store.next_position
+
+    def append_message(self, record: dict, timestamp: datetime) -> int:
+        """Store a message and return its id."""
+        with self._message_lock:
+            return self.message_store.append(record, timestamp=timestamp)
+
+    def append_messages(self, records: List[dict], timestamp: datetime) -> List[int]:
+        """Store a batch of messages and return their ids."""
+        with self._message_lock:
+            return [self.message_store.append(record, timestamp=timestamp) for record in records]
+
+    def get_message(self, message_id: int, columns: List[str]) -> dict:
+        with self._message_lock:
+            return self.message_store.row(message_id, columns)
+
+    def query_messages(self, since: datetime = None, channel_names: List[str] = None,
+                       after: int = None, columns: List[str] = None):
+        """Messages after the `after` id, oldest first, with their `message_id`, and the
+        id of the last stored message. A cursor from before a restart starts over."""
+        with self._message_lock:
+            # only pick the rows under the lock, building them can take a while
+            if after is not None and after >= self.message_store.next_position:
+                after = -1
+            positions = self.message_store.positions(
+                since=since, keys=channel_names or None, start=None if after is None else after + 1
+            )
+            view = self.message_store.view()
+        messages = []
+        for position in positions:
+            row = view.row(position, columns)
+            row['message_id'] = position
+            messages.append(row)
+        return messages, view.next_position - 1
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._message_lock:
+            view = self.message_store.view()
+        return view.to_frame()
+
+    def close(self):
+        pass
+
+
+class SQLiteState:
+    """Bot status and recent messages in a SQLite database shared by API workers.
+
+    Every uvicorn worker opens the same database, in WAL mode, so each of them ingests
+    messages and serves reads with the same message ids and status. SQLite serializes
+    the writes; each thread keeps its own connection. The status version lives in the
+    database too, so workers notice a change made by another one by polling
+    `status_version`. Messages beyond `capacity` or older than `max_age_seconds` are
+    deleted as new ones come in.
+
+    Waiting for the database lock can take a while when workers contend for it, so
+    the event loop goes through `run`, which does the work on this worker's own
+    state thread.
+    """
+    shared = True
+
+    def __init__(self, path: str, status: dict, columns: List[str], capacity: int = 100000,
+                 max_age_seconds: Optional[float] = None, evict_every: int = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.columns = [column for column in columns if column != 'timestamp']
+        self.capacity = capacity
+        self.max_age_seconds = max_age_seconds
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._appended = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state')
+        self._leader_file = None
+
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS status ('
+            'id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL, '
+            'version INTEGER NOT NULL, epoch INTEGER NOT NULL)'
+        )
+        conn.execute(
+            'INSERT OR IGNORE INTO status (id, data, version, epoch) VALUES (0, ?, 0, ?)',
+            (json.dumps(status), int(time.time()))
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            + ', '.join(self.columns) + ', timestamp REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_name, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)')
+        self._insert = (
+            f'INSERT INTO messages ({", ".join(self.columns)}, timestamp) '
+            f'VALUES ({", ".join("?" * (len(self.columns) + 1))})'
+        )
+        self.logger.info(f'Shared API state at {path} has {len(self)} messages.')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    async def run(self, func, *args, **kwargs):
+        """Run a state method from the event loop, on the state thread."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def claim_leader(self) -> bool:
+        """Try to become the worker sending OSC for all of them.
+
+        Holds a lock file next to the database until the process exits, so another
+        worker takes over by calling this again.
+        """
+        if self._leader_file is None:
+            self._leader_file = open(self.path + '.leader', 'w')
+        try:
+            fcntl.flock(self._leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def get_status(self) -> dict:
+        return json.loads(self._conn().execute('SELECT data FROM status').fetchone()[0])
+
+    def get_status_with_etag(self):
+        data, version, epoch = self._conn().execute('SELECT data, version, epoch FROM status').fetchone()
+        return json.loads(data), f'"{epoch}-{version}"'
+
+    def set_status(self, status: dict) -> int:
+        """Replace the status and return its new version."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('UPDATE status SET data = ?, version = version + 1', (json.dumps(status),))
+            version = conn.execute('SELECT version FROM status').fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return version
+
+    def status_version(self) -> int:
+        return self._conn().execute('SELECT version FROM status').fetchone()[0]
+
+    def status_etag(self) -> str:
+        version, epoch = self._conn().execute('SELECT version, epoch FROM status').fetchone()
+        return f'"{epoch}-{version}"'
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def next_message_id(self) -> int:
+        # ids are never reused, even when the latest messages were evicted
+        row = self._conn().execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        return (row[0] if row else 0) + 1
+
+    def append_message(self, record: dict, timestamp: datetime) -> int:
+        """Store a message and return its id."""
+        return self.append_messages([record], timestamp)[0]
+
+    def append_messages(self, records: List[dict], timestamp: datetime) -> List[int]:
+        """Store a batch of messages in one transaction and return their ids."""
+        rows = []
+        for record in records:
+            values = [record.get(column) for column in self.columns]
+            values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+            values.append(timestamp.timestamp())
+            rows.append(values)
+
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(self._insert, rows)
+            # the batch got consecutive ids, we held the write lock
+            last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        before = self._appended
+        self._appended += len(rows)
+        if self._appended // self.evict_every > before // self.evict_every:
+            self._evict(last_id)
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def _evict(self, last_id: int):
+        conn = self._conn()
+        conn.execute('DELETE FROM messages WHERE id <= ?', (last_id - self.capacity,))
+        if self.max_age_seconds:
+            conn.execute('DELETE FROM messages WHERE timestamp < ?', (time.time() - self.max_age_seconds,))
+
+    def _rows(self, query: str, params, columns: List[str]):
+        columns = columns or self.columns
+        rows = self._conn().execute(
+            query.format(columns=', '.join(['id'] + columns)), params
+        ).fetchall()
+        messages = []
+        for row in rows:
+            message = dict(zip(columns, row[1:]))
+            if 'is_command' in message and message['is_command'] is not None:
+                message['is_command'] = bool(message['is_command'])
+            if isinstance(message.get('datetime'), str):
+                message['datetime'] = datetime.fromisoformat(message['datetime'])
+            message['message_id'] = row[0]
+            messages.append(message)
+        return messages
+
+    def get_message(self, message_id: int, columns: List[str]) -> dict:
+        messages = self._rows('SELECT {columns} FROM messages WHERE id = ?', (message_id,), columns)
+        if not messages:
+            raise KeyError(message_id)
+        del messages[0]['message_id']
+        return messages[0]
+
+    def query_messages(self, since: datetime = None, channel_names: List[str] = None,
+                       after: int = None, columns: List[str] = None):
+        """Messages after the `after` id, oldest first, with their `message_id`, and the
+        id of the last stored message. A cursor from another database starts over."""
+        last_id = self.next_message_id() - 1
+        if after is not None and after > last_id:
+            after = -1
+        query = 'SELECT {columns} FROM messages WHERE id > ? AND id <= ?'
+        params = [-1 if after is None else after, last_id]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            params.append(since.timestamp())
+        if channel_names:
+            query += f' AND channel_name IN ({", ".join("?" * len(channel_names))})'
+            params.extend(channel_names)
+        return self._rows(query + ' ORDER BY id', params, columns), last_id
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.read_sql_query('SELECT * FROM messages ORDER BY id', self._conn(), index_col='id')
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        if self._leader_file is not None:
+            self._leader_file.close()
+            self._leader_file = None
+
+
+def create_state(cfg: dict, status: dict, message_store: MessageStore):
+    """Build the state backend configured in the `state` section of the API config."""
+    state_cfg = cfg.get('state') or {}
+    backend = state_cfg.get('backend', 'local')
+    if backend == 'local':
+        return LocalState(status, message_store)
+    if backend == 'sqlite':
+        return SQLiteState(
+            state_cfg.get('path', './data/state.db'),
+            status,
+            message_store.columns,
+            capacity=message_store.capacity,
+            max_age_seconds=message_store.max_age.total_seconds() if message_store.max_age else None
+        )
+    raise ValueError(f'Unknown API state backend {backend!r}, use local or sqlite.')
@@ -0,0 +1,161 @@
+import re
+import time
+from array import array
+from collections import OrderedDict
+
+
+class CountMinSketch:
+    """Approximate counts in fixed memory: `depth` rows of `width` counters.
+
+    Estimates never undercount; they overcount only when keys collide in every row.
+    """
+    __slots__ = ('width', 'depth', 'rows')
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for _ in range(depth)]
+
+    def _slots(self, key):
+        return [hash((seed, key)) % self.width for seed in range(self.depth)]
+
+    def add(self, key, count: int = 1) -> int:
+        """Count the key and return its new estimate."""
+        estimate = None
+        for row, slot in zip(self.rows, self._slots(key)):
+            row[slot] += count
+            estimate = row[slot] if estimate is None else min(estimate, row[slot])
+        return estimate
+
+    def estimate(self, key) -> int:
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = array('l', [0]) * self.width
+
+
+class SlidingWindowCounter:
+    """Approximate per-key counts over the last `window` seconds, in fixed memory.
+
+    Two count-min sketches take turns: one counts the current window, the other keeps
+    the previous one. The previous window's count is weighted by how much of it still
+    overlaps the sliding window.
+    """
+    def __init__(self, window: float, width: int = 2048, depth: int = 4):
+        self.window = window
+        self._current = CountMinSketch(width, depth)
+        self._previous = CountMinSketch(width, depth)
+        self._started = None
+
+    def _rotate(self, now: float):
+        if self._started is None:
+            self._started = now
+        elapsed = now - self._started
+        if elapsed < self.window:
+            return
+        self._current, self._previous = self._previous, self._current
+        self._current.clear()
+        if elapsed >= 2 * self.window:
+            # nothing happened for a whole window
+            self._previous.clear()
+        self._started = now - elapsed % self.window
+
+    def add(self, key, now: float = None) -> float:
+        """Count the key and return its estimated count over the sliding window."""
+        now = time.monotonic() if now is None else now
+        self._rotate(now)
+        overlap = 1 - (now - self._started) / self.window
+        return self._current.add(key) + overlap * self._previous.estimate(key)
+
+
+class SpamFilter:
+    """Rate limits and near-duplicate suppression for incoming chat.
+
+    Messages are refused when their author or channel sends more than the allowed
+    number of messages in a sliding window, when an author repeats one of their own
+    recent messages, or when the same text of at least `min_copy_length` characters
+    floods a channel (copypasta raids). Texts are compared after normalizing case,
+    spacing, punctuation and repeated letters. Commands only count towards the rates,
+    repeating them is up to the bot's cooldowns. Counters are count-min sketches and
+    per-author history is an LRU of at most `max_users` authors, so memory stays flat
+    however many chatters show up.
+    """
+    NORMALIZE_PATTERN = re.compile(r'[\W_]+')
+    REPEAT_PATTERN = re.compile(r'(.)\1+')
+
+    def __init__(self, window: float = 10, max_per_user: int = 5, max_per_channel: int = 200,
+                 duplicate_window: float = 30, user_history: int = 3, max_copies: int = 10,
+                 min_copy_length: int = 10,
+                 max_users: int = 10000, sketch_width: int = 2048, sketch_depth: int = 4):
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.duplicate_window = duplicate_window
+        self.user_history = user_history
+        self.max_copies = max_copies
+        self.min_copy_length = min_copy_length
+        self.max_users = max_users
+
+        self._rates = SlidingWindowCounter(window, sketch_width, sketch_depth)
+        self._copies = SlidingWindowCounter(duplicate_window, sketch_width, sketch_depth)
+        self._recent = OrderedDict()  # (channel name, author) -> [(text hash, monotonic time)]
+        self.dropped = {'user-rate': 0, 'channel-rate': 0, 'duplicate': 0, 'copypasta': 0}
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        """Build a filter from a `spam-filter` config section, None if it's disabled."""
+        if not cfg or not cfg.get('enabled', True):
+            return None
+        return cls(
+            window=cfg.get('window', 10),
+            max_per_user=cfg.get('max-per-user', 5),
+            max_per_channel=cfg.get('max-per-channel', 200),
+            duplicate_window=cfg.get('duplicate-window', 30),
+            user_history=cfg.get('user-history', 3),
+            max_copies=cfg.get('max-copies', 10),
+            min_copy_length=cfg.get('min-copy-length', 10),
+            max_users=cfg.get('max-users', 10000),
+            sketch_width=cfg.get('sketch-width', 2048),
+            sketch_depth=cfg.get('sketch-depth', 4)
+        )
+
+    def normalize(self, text: str) -> str:
+        text = self.NORMALIZE_PATTERN.sub(' ', text.lower()).strip()
+        return self.REPEAT_PATTERN.sub(r'\1', text)
+
+    def _is_repeat(self, user_key, text_hash, now):
+        history = self._recent.get(user_key)
+        if history is None:
+            history = self._recent[user_key] = []
+            if len(self._recent) > self.max_users:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(user_key)
+        history[:] = [(seen, at) for seen, at in history if now - at < self.duplicate_window]
+        repeat = any(seen == text_hash for seen, _ in history)
+        if not repeat:
+            history.append((text_hash, now))
+            del history[:-self.user_history]
+        return repeat
+
+    def check(self, channel_name: str, author, text: str, is_command: bool = False, now: float = None):
+        """Count the message and return why it is spam, or None to let it through."""
+        now = time.monotonic() if now is None else now
+        user_key = (channel_name, author)
+        reason = None
+        if self._rates.add(('user',) + user_key, now) > self.max_per_user:
+            reason = 'user-rate'
+        elif self._rates.add(('channel', channel_name), now) > self.max_per_channel:
+            reason = 'channel-rate'
+        elif not is_command:
+            text = self.normalize(text or '')
+            text_hash = hash(text)
+            if self._is_repeat(user_key, text_hash, now):
+                reason = 'duplicate'
+            elif (len(text) >= self.min_copy_length
+                  and self._copies.add((channel_name, text_hash), now) > self.max_copies):
+                reason = 'copypasta'
+
+        if reason:
+            self.dropped[reason] += 1
+        return reason
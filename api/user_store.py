@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Set
+
+
+class UserStore:
+    """Durable user store on SQLite in WAL mode.
+
+    Each user is one row keyed by username, so an update only writes that user.
+    Wallet ids are indexed in their own table for lookups by wallet.
+    """
+    def __init__(self, path='./data/users.db'):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'username TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_wallets ('
+            'wallet_id TEXT NOT NULL, username TEXT NOT NULL, PRIMARY KEY (wallet_id, username))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS user_wallets_username ON user_wallets (username)')
+        self.logger.info(f'User store at {path} has {len(self)} users.')
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def data_version(self) -> int:
+        """Changes whenever another connection, e.g. another API worker, commits a write."""
+        with self._lock:
+            return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    @staticmethod
+    def _wallet_ids(info: dict) -> List[str]:
+        return info.get('rally', {}).get('rallyNetworkWalletIds', [])
+
+    def upsert(self, info: dict):
+        """Insert or replace one user, keyed by username."""
+        username = info['username']
+        with self._lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO users (username, data, updated_at) VALUES (?, ?, ?)',
+                    (username, json.dumps(info, default=str), time.time())
+                )
+                self.conn.execute('DELETE FROM user_wallets WHERE username = ?', (username,))
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO user_wallets (wallet_id, username) VALUES (?, ?)',
+                    [(wallet_id, username) for wallet_id in self._wallet_ids(info)]
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def get(self, username: str) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_wallet(self, wallet_id: str) -> List[dict]:
+        """Return the users that registered a wallet id."""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT users.data FROM user_wallets JOIN users USING (username) '
+                'WHERE user_wallets.wallet_id = ? ORDER BY users.username',
+                (wallet_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def usernames_by_wallets(self, wallet_ids) -> Set[str]:
+        """Return the usernames that registered any of the wallet ids."""
+        wallet_ids = list(wallet_ids)
+        usernames = set()
+        with self._lock:
+            # stay well below SQLite's limit on query parameters
+            for i in range(0, len(wallet_ids), 500):
+                chunk = wallet_ids[i:i + 500]
+                rows = self.conn.execute(
+                    f'SELECT username FROM user_wallets WHERE wallet_id IN ({",".join("?" * len(chunk))})',
+                    chunk
+                ).fetchall()
+                usernames.update(row[0] for row in rows)
+        return usernames
+
+    def page(self, after: str = None, limit: int = None, usernames: Set[str] = None):
+        """Return users ordered by username after the `after` cursor, and the next cursor.
+
+        With `usernames`, only those users are looked up, so the cost follows the
+        number of selected users rather than the size of the store.
+        """
+        if usernames is not None:
+            return self._page_of(sorted(name for name in usernames if after is None or name > after), limit)
+
+        query = 'SELECT username, data FROM users'
+        params = []
+        if after is not None:
+            query += ' WHERE username > ?'
+            params.append(after)
+        query += ' ORDER BY username'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        next_cursor = rows[-1][0] if limit is not None and len(rows) == limit else None
+        return [json.loads(data) for _, data in rows], next_cursor
+
+    def _page_of(self, usernames: List[str], limit: int = None):
+        """Page through the given usernames, which must be sorted."""
+        rows = []
+        with self._lock:
+            # chunks in username order, so each one continues where the last stopped
+            for i in range(0, len(usernames), 500):
+                chunk = usernames[i:i + 500]
+                query = (
+                    f'SELECT username, data FROM users WHERE username IN ({",".join("?" * len(chunk))}) '
+                    'ORDER BY username'
+                )
+                params = list(chunk)
+                if limit is not None:
+                    query += ' LIMIT ?'
+                    params.append(limit - len(rows))
+                rows.extend(self.conn.execute(query, params).fetchall())
+                if limit is not None and len(rows) == limit:
+                    break
+        next_cursor = rows[-1][0] if limit is not None and len(rows) == limit else None
+        return [json.loads(data) for _, data in rows], next_cursor
+
+    def import_json(self, path: str):
+        """Import users from the old `users.json` format."""
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as f:
+            data = json.load(f)
+        for info in data['users']:
+            self.upsert(info)
+        self.logger.info(f'Imported {len(data["users"])} users from {path}')
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,111 @@
+"""Per-message overhead of the API's ingest and read serialization.
+
+Compares the original path (one `TwitchMessage` validated per POST, `.dict()` twice,
+the default JSON encoder for reads) with the new one (column batches validated in
+bulk, one dict per message, orjson for reads). The `batch` row compares against the
+intermediate path posting a `TwitchMessageBatch`. HTTP overhead is left out, so
+the single-message numbers understate what one POST per message cost. Run from
+the repo root:
+
+    python benchmarks/bench_ingest.py --messages 50 --rounds 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+import orjson
+from fastapi.encoders import jsonable_encoder
+sys.path.insert(0, os.getcwd())  # so we can import from api
+from api.api_model import TwitchMessage, TwitchMessageBatch, TwitchMessageColumns  # noqa
+
+
+def make_messages(count):
+    now = datetime.now().isoformat()
+    return [
+        {
+            'channel_name': 'colinbenders',
+            'author_name': f'chatter{i % 37}',
+            'author_id': str(1000 + i % 37),
+            'message_text': f'message number {i} with a few more words in it',
+            'is_command': i % 10 == 0,
+            'command_type': 'talk' if i % 10 == 0 else None,
+            'datetime': now
+        }
+        for i in range(count)
+    ]
+
+
+def to_columns(messages):
+    names = ['channel_name', 'author_name', 'author_id', 'message_text', 'command_type', 'datetime']
+    return {name: [message[name] for message in messages] for name in names}
+
+
+def ingest_single(messages):
+    records = []
+    for payload in messages:
+        # one POST /twitch/message per message
+        message = TwitchMessage.parse_obj(payload)
+        records.append(message.dict())  # store_message
+        message.dict()  # send_twitch_message_osc
+    return records
+
+
+def ingest_batch(payload):
+    batch = TwitchMessageBatch.parse_obj(payload)
+    records = []
+    for message in batch.messages:
+        records.append(message.dict())
+        message.dict()
+    return records
+
+
+def ingest_after(payload):
+    return list(TwitchMessageColumns.parse_obj(payload).records())
+
+
+def read_before(rows):
+    return json.dumps(jsonable_encoder(rows)).encode()
+
+
+def read_after(rows):
+    return orjson.dumps(rows)
+
+
+def per_message_us(func, payload, messages, rounds):
+    func(payload)  # warm up
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(payload)
+    return 1e6 * (time.perf_counter() - started) / (rounds * messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=50, help='messages per batch')
+    parser.add_argument('--rounds', type=int, default=200, help='batches per measurement')
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    rows = ingest_after(to_columns(messages))
+    ingest = per_message_us(ingest_after, to_columns(messages), args.messages, args.rounds)
+    results = [
+        ('ingest', per_message_us(ingest_single, messages, args.messages, args.rounds), ingest),
+        ('read', per_message_us(read_before, rows, args.messages, args.rounds),
+         per_message_us(read_after, rows, args.messages, args.rounds))
+    ]
+    batch = per_message_us(ingest_batch, {'messages': messages}, args.messages, args.rounds)
+
+    print(f'{args.messages} messages per batch, {args.rounds} rounds, microseconds per message:')
+    print(f'{"":8}{"before":>10}{"after":>10}{"speedup":>10}')
+    for name, before, after in results:
+        print(f'{name:8}{before:10.2f}{after:10.2f}{before / after:9.1f}x')
+    total_before = sum(before for _, before, _ in results)
+    total_after = sum(after for _, _, after in results)
+    print(f'{"total":8}{total_before:10.2f}{total_after:10.2f}{total_before / total_after:9.1f}x')
+    print(f'{"batch":8}{batch:10.2f}{ingest:10.2f}{batch / ingest:9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import deque
+import aiohttp
+from bots.chat_record import ChatRecord
+
+
+class APIForwarder:
+    """Forward chat messages to the Jack API in batches, off the bot's hot path.
+
+    `put` only appends a `ChatRecord` to a bounded in-memory queue, dropping the
+    oldest message when full. A single background task coalesces queued messages into
+    batches by size or time, turns each batch into columns and posts it over a pooled
+    keep-alive session, retrying with exponential backoff.
+    One sender task means batches go out in order, so per-channel ordering is kept.
+    """
+    def __init__(self, url, max_queue=10000, batch_size=50, batch_interval=0.02,
+                 max_retries=5, backoff=0.5, max_backoff=10.0, pool_size=4, timeout=10.0):
+        self.logger = logging.getLogger(__name__)
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.dropped = 0
+        self.session = None
+        self._queue = deque(maxlen=max_queue)
+        self._wakeup = None
+        self._task = None
+
+    @classmethod
+    def from_config(cls, url, cfg):
+        """Build a forwarder from the `forwarder` section of the bot config."""
+        return cls(
+            url,
+            max_queue=cfg.get('max-queue', 10000),
+            batch_size=cfg.get('batch-size', 50),
+            batch_interval=cfg.get('batch-interval', 0.02),
+            max_retries=cfg.get('max-retries', 5),
+            backoff=cfg.get('backoff', 0.5),
+            max_backoff=cfg.get('max-backoff', 10.0),
+            pool_size=cfg.get('pool-size', 4)
+        )
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def start(self):
+        """Open the HTTP pool and start sending. Must run on the bot's event loop.
+
+        Safe to call again, e.g. on every reconnect: a running forwarder is left alone.
+        """
+        if self._task and not self._task.done():
+            return
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        self.logger.info(f'API forwarder sending to {self.url}')
+
+    def put(self, message):
+        """Queue a message for sending, never blocks."""
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                self.logger.warning(f'API forwarder queue full, dropped {self.dropped} messages so far.')
+        self._queue.append(message)
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if len(self._queue) < self.batch_size and self.batch_interval:
+                # give a batch the chance to fill up
+                await asyncio.sleep(self.batch_interval)
+            batch = self._take_batch()
+            try:
+                await self._send(batch)
+            except Exception as ex:
+                # keep the sender alive, put() would never restart it
+                self.dropped += len(batch)
+                self.logger.error(f'Dropped {len(batch)} messages after an unexpected error: {ex!r}')
+
+    def _take_batch(self):
+        return [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+    async def _send(self, batch):
+        """Post one batch, retrying with exponential backoff."""
+        payload = ChatRecord.to_columns(batch)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.session.post(self.url, json=payload) as resp:
+                    if resp.status == 200:
+                        return
+                    text = await resp.text()
+                    self.logger.warning(f'Failed sending {len(batch)} messages: {resp.status} {text}')
+                    if 400 <= resp.status < 500 and resp.status != 429:
+                        # the API refused the batch, retrying won't help
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                self.logger.warning(f'Failed sending {len(batch)} messages: {ex!r}')
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+
+        self.dropped += len(batch)
+        self.logger.error(f'Gave up sending {len(batch)} messages after {self.max_retries} retries.')
+
+    async def close(self):
+        """Send whatever is still queued and close the HTTP pool."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.session:
+            while self._queue:
+                await self._send(self._take_batch())
+            await self.session.close()
+            self.session = None
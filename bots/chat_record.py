@@ -0,0 +1,23 @@
+class ChatRecord:
+    """Compact record of one chat message on its way to the API.
+
+    Built once per message on the bot's hot path; the payload for the API is only
+    made by the forwarder, off the event handler.
+    """
+    __slots__ = ('channel_name', 'author_name', 'author_id', 'message_text', 'command_type', 'datetime')
+    COLUMNS = ('channel_name', 'author_name', 'author_id', 'message_text', 'command_type')
+
+    def __init__(self, channel_name, author_name, author_id, message_text, datetime, command_type=None):
+        self.channel_name = channel_name
+        self.author_name = author_name
+        self.author_id = author_id
+        self.message_text = message_text
+        self.datetime = datetime
+        self.command_type = command_type
+
+    @classmethod
+    def to_columns(cls, records):
+        """A batch of records as one list per field, for the API's column batch endpoint."""
+        columns = {name: [getattr(record, name) for record in records] for name in cls.COLUMNS}
+        columns['datetime'] = [record.datetime.isoformat() for record in records]
+        return columns
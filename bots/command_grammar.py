@@ -0,0 +1,140 @@
+import math
+import re
+import time
+from collections import OrderedDict
+
+
+def finite_float(text: str) -> float:
+    """Convert to float, refusing values like 1e999 that overflow to infinity."""
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f'{text} is not a finite number')
+    return value
+
+
+# argument type -> (regex for its text, conversion of the matched text, raising ValueError if invalid)
+ARG_TYPES = {
+    'int': (r'[+-]?\d+', int),
+    'float': (r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?', finite_float),
+    'str': (r'\S+', str),
+    'text': (r'.+', str)  # the rest of the line, only allowed as the last argument
+}
+ARG_PATTERN = re.compile(r'<(\w+):(\w+)>')
+
+
+class CommandSpec:
+    """One chat command compiled from a grammar like `donate <amount:float> <token:str>`.
+
+    The grammar is compiled to a single regex at startup, so parsing never raises:
+    `parse` returns a dict of typed arguments, or None when the text doesn't match.
+    Words after the last argument are ignored, as chatters like to add some. Results
+    are cached per argument text, since spammed commands tend to repeat.
+    """
+    def __init__(self, grammar: str, command_type: str = None, cooldown: float = 0,
+                 reply: str = None, cache_size: int = 256):
+        words = grammar.split()
+        if not words or ARG_PATTERN.fullmatch(words[0]):
+            raise ValueError(f'Command grammar must start with the command name: {grammar!r}')
+        self.name = words[0]
+        self.grammar = grammar
+        self.command_type = command_type or self.name
+        self.cooldown = cooldown
+        self.reply = reply
+
+        self.args = []  # (name, conversion)
+        patterns = []
+        for i, word in enumerate(words[1:], start=1):
+            arg = ARG_PATTERN.fullmatch(word)
+            if arg is None:
+                # a literal keyword
+                patterns.append(re.escape(word))
+                continue
+            name, arg_type = arg.groups()
+            if arg_type not in ARG_TYPES:
+                raise ValueError(f'Unknown argument type {arg_type!r} in command grammar {grammar!r}')
+            if arg_type == 'text' and i != len(words) - 1:
+                raise ValueError(f'Only the last argument may be text in command grammar {grammar!r}')
+            pattern, conversion = ARG_TYPES[arg_type]
+            patterns.append(f'({pattern})')
+            self.args.append((name, conversion))
+        if patterns:
+            self._regex = re.compile(r'\s+'.join(patterns) + r'(?:\s.*)?', re.DOTALL)
+        else:
+            self._regex = re.compile(r'.*', re.DOTALL)
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def parse(self, args: str):
+        """Typed arguments from the text after the command name, or None if invalid."""
+        parsed = self._cache.get(args, False)
+        if parsed is not False:
+            self._cache.move_to_end(args)
+            return parsed
+
+        match = self._regex.fullmatch(args.strip())
+        try:
+            parsed = None if match is None else {
+                name: conversion(value) for (name, conversion), value in zip(self.args, match.groups())
+            }
+        except ValueError:
+            parsed = None
+
+        self._cache[args] = parsed
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return parsed
+
+
+class Cooldowns:
+    """Per-user command cooldowns, remembering at most `max_users` recent users."""
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._last_used = OrderedDict()  # (command name, user id) -> monotonic time
+
+    def ready(self, spec: CommandSpec, user_id, now: float = None) -> bool:
+        """Whether the user may run the command now, starting the cooldown if so."""
+        if not spec.cooldown:
+            return True
+        now = time.monotonic() if now is None else now
+        key = (spec.name, user_id)
+        last_used = self._last_used.get(key)
+        if last_used is not None and now - last_used < spec.cooldown:
+            return False
+        self._last_used[key] = now
+        self._last_used.move_to_end(key)
+        if len(self._last_used) > self.max_users:
+            self._last_used.popitem(last=False)
+        return True
+
+
+class CommandRegistry:
+    """The chat commands the bot answers to, looked up by name."""
+    def __init__(self):
+        self.commands = {}
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        """Build the registry from the `commands` section of the bot config."""
+        registry = cls()
+        for name, command_cfg in (cfg or {}).items():
+            command_cfg = command_cfg or {}
+            spec = CommandSpec(
+                command_cfg.get('grammar', name),
+                command_type=command_cfg.get('command-type'),
+                cooldown=command_cfg.get('cooldown', 0),
+                reply=command_cfg.get('reply')
+            )
+            if spec.name != name:
+                raise ValueError(f'Command {name!r} has a grammar for {spec.name!r}.')
+            registry.register(spec)
+        return registry
+
+    def register(self, spec: CommandSpec):
+        self.commands[spec.name] = spec
+
+    def get(self, name: str):
+        return self.commands.get(name)
+
+    def __iter__(self):
+        return iter(self.commands.values())
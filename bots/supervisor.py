@@ -0,0 +1,123 @@
+import logging
+import multiprocessing
+import queue
+import time
+from datetime import datetime, timedelta
+from utils import logging_setup
+from connectors.twitch_connector import TwitchConnector
+from bots.twitch_bot import TwitchBot
+
+
+def run_shard(cfg, token, shard_index, shard_count, report_queue, control_queue):
+    """Worker process: run the bot for one shard of the channels."""
+    logging_setup(log_level=cfg['log-level'])
+    bot = TwitchBot(
+        cfg=cfg,
+        token=token,
+        shard_index=shard_index,
+        shard_count=shard_count,
+        report_queue=report_queue,
+        control_queue=control_queue
+    )
+    bot.run()
+
+
+class BotSupervisor:
+    """Run the Twitch bot as `shards` worker processes, each handling part of the channels.
+
+    Channels are assigned to shards by a stable hash, so each worker follows
+    `/twitch/status` by itself and joins or leaves channels as `channel_names` changes.
+    The supervisor gets one OAuth token for all workers, restarts workers that die
+    and logs the ingest rate and lag each worker reports.
+
+    The token is refreshed `refresh-margin-seconds` before it expires and handed to the
+    running workers, which switch to it in place. Their IRC connections stay up, so
+    there is no chat gap and no cold start at refresh time.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.logger = logging.getLogger(__name__)
+        self.shard_count = cfg.get('shards', 1)
+        self.token_exp_duration = timedelta(seconds=cfg['refresh']['expiration-seconds'])
+        self.refresh_margin = timedelta(seconds=cfg['refresh'].get('refresh-margin-seconds', 300))
+        self.check_seconds = cfg['refresh']['expiration-check']
+        self.twitch_connector = TwitchConnector(cfg)
+        self.reports = multiprocessing.Queue()
+        self.procs = {}
+        self.controls = {}
+        self.shard_stats = {}
+
+    def _start_shard(self, shard_index):
+        self.controls[shard_index] = multiprocessing.Queue()
+        proc = multiprocessing.Process(
+            target=run_shard,
+            args=(self.cfg, self.token, shard_index, self.shard_count, self.reports, self.controls[shard_index]),
+            daemon=True
+        )
+        proc.start()
+        self.procs[shard_index] = proc
+
+    def start(self):
+        self.token = self.twitch_connector.get_oauth_token()
+        self.token_time = datetime.now()
+        for shard_index in range(self.shard_count):
+            self._start_shard(shard_index)
+        self.logger.info(f'Started {self.shard_count} Twitch bot shards.')
+
+    def _refresh_token(self):
+        """Get a new token and hand it to every running shard."""
+        self.logger.warning('Refreshing Twitch token...')
+        try:
+            self.token = self.twitch_connector.get_oauth_token_refresh()
+        except Exception as ex:
+            self.logger.error(f'Twitch token refresh failed, retrying at the next check: {ex!r}')
+            return
+        self.token_time = datetime.now()
+        for control in self.controls.values():
+            control.put({'token': self.token})
+        self.logger.warning(':tada:Twitch token refreshed for all shards!:tada:')
+
+    def stop(self):
+        for proc in self.procs.values():
+            proc.terminate()  # sends a SIGTERM
+        for proc in self.procs.values():
+            proc.join()
+
+    def _check_shards(self):
+        for shard_index, proc in self.procs.items():
+            if not proc.is_alive():
+                self.logger.error(f'Shard {shard_index} exited with {proc.exitcode}, restarting it.')
+                self._start_shard(shard_index)
+
+    def _read_reports(self, timeout):
+        """Collect shard reports for up to `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                report = self.reports.get(timeout=remaining)
+            except queue.Empty:
+                return
+            self.shard_stats[report['shard']] = report
+            self.logger.info(
+                f'Shard {report["shard"]}: {report["messages_per_second"]:.1f} msg/s, '
+                f'lag avg {report["avg_lag"]:.3f}s max {report["max_lag"]:.3f}s, '
+                f'{report["cpu_us_per_message"]:.0f}us CPU per message, {report["spam_dropped"]} spam dropped, '
+                f'{report["forward_queue"]} queued for the API, channels {report["channels"]}'
+            )
+
+    def run(self):
+        self.start()
+        while True:
+            if datetime.now() - self.token_time > self.token_exp_duration - self.refresh_margin:
+                self._refresh_token()
+            else:
+                self.logger.info('Token refresh check passed.')
+            self._check_shards()
+            self._read_reports(self.check_seconds)
+
+
+def external_run_bot(cfg):
+    BotSupervisor(cfg).run()
@@ -2,18 +2,38 @@ import asyncio
 import os
 import logging
 import requests as r
-import multiprocessing
+import queue
 import time
+import zlib
+import aiohttp
 from twitchio.ext import commands
 from utils import load_config, logging_setup
 from connectors.twitch_connector import TwitchConnector
+from bots.api_forwarder import APIForwarder
+from bots.chat_record import ChatRecord
+from bots.command_grammar import CommandRegistry, Cooldowns
+from api.spam_filter import SpamFilter
 from urllib.parse import urljoin
 from datetime import datetime, timedelta
 
 
+# used when the config has no `commands` section
+DEFAULT_COMMANDS = {
+    'hello': {'command-type': 'greeting', 'reply': '/color Green Hello {author_name}!'},
+    'talk': {'grammar': 'talk <text:text>'},
+    'donate': {'grammar': 'donate <amount:float> <token:str>'}
+}
+
+
+def shard_of(channel_name, shard_count):
+    """Stable shard index of a channel, so a channel stays on its shard as the list changes."""
+    return zlib.crc32(channel_name.lower().encode()) % shard_count
+
+
 class TwitchBot(commands.Bot):
 
-    def __init__(self, cfg=None, sec_between_check=3, sec_token_exp=5):
+    def __init__(self, cfg=None, sec_between_check=3, sec_token_exp=5, token=None,
+                 shard_index=0, shard_count=1, report_queue=None, control_queue=None):
         # Initialise our Bot with our access token, prefix and a list of channels to join on boot...
         # prefix can be a callable, which returns a list of strings or a string...
         # initial_channels can also be a callable which returns a list of strings...
@@ -23,23 +43,49 @@ class TwitchBot(commands.Bot):
             self.cfg = load_config(os.environ.get('CONFIG_FILE', 'configs/twitch-bot.yml'))
         self.bot_mode = cfg['bot-mode']
         self.sec_between_check = sec_between_check
+        self.status_long_poll = self.cfg.get('status-long-poll', True)
+        self.status_wait_timeout = 30
         self.command_prefix = '?'
         self.logger = logging.getLogger(__name__)
+        self.log_sample_every = self.cfg.get('log-sample-every', 1)
+        self._log_counter = 0
+        self.command_registry = CommandRegistry.from_config(self.cfg.get('commands', DEFAULT_COMMANDS))
+        self.cooldowns = Cooldowns(self.cfg.get('cooldown-max-users', 10000))
+        self.spam_filter = SpamFilter.from_config(self.cfg.get('spam-filter'))
+        # commands that need more than forwarding to the API, the others are forwarded as is
+        handlers = {'donate': self.donate}
+        self.command_handlers = {spec.name: (spec, handlers.get(spec.name)) for spec in self.command_registry}
         self.token_exp_duration = timedelta(seconds=sec_token_exp)
 
-        self.twitch_connector = TwitchConnector(self.cfg)
+        # this bot only handles the channels of its own shard
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.report_queue = report_queue
+        self.control_queue = control_queue
+        self.report_seconds = self.cfg.get('shard-report-seconds', 30)
+        self._reset_shard_stats()
+
+        self.token = token
+        if not self.token:
+            self.twitch_connector = TwitchConnector(self.cfg)
+            self.token = self.twitch_connector.get_oauth_token()
 
         self._run_bot()
 
     def _run_bot(self):
-        """Used in init and on token expiration."""
+        """Set up the twitchio bot for the channels of our shard."""
+        self.joined_channels = set(self.shard_channels(self.cfg['channel-names']))
         super().__init__(
-            token=self.twitch_connector.get_oauth_token(),
+            token=self.token,
             prefix=self.command_prefix,
-            initial_channels=self.cfg['channel-names']
+            initial_channels=list(self.joined_channels)
         )
         asyncio.run(self._init_jack_api())
 
+    def shard_channels(self, channel_names):
+        """The channels this bot's shard is responsible for."""
+        return [name for name in channel_names if shard_of(name, self.shard_count) == self.shard_index]
+
     async def _init_jack_api(self):
         """Set up for connecting to the Jack API."""
         if 'url' in self.cfg['api']:
@@ -47,9 +93,15 @@ class TwitchBot(commands.Bot):
         else:
             self.api_url = f'http://{self.cfg["api"]["host"]}:{self.cfg["api"]["port"]}/'
 
-        self.twitch_status_endpoint = urljoin(self.api_url, 'twitch/status/')
-        self.twitch_message_endpoint = urljoin(self.api_url, 'twitch/message/')
+        self.twitch_status_endpoint = urljoin(self.api_url, 'twitch/status')
+        self.twitch_status_wait_endpoint = urljoin(self.api_url, 'twitch/status/wait')
+        self.twitch_messages_endpoint = urljoin(self.api_url, 'twitch/messages/columns')
         self.status = {'mode': self.bot_mode}
+        self._background_started = False
+        self.forwarder = APIForwarder.from_config(
+            self.twitch_messages_endpoint,
+            self.cfg.get('forwarder', {})
+        )
 
         self.logger.info(f'TwitchBot using {self.api_url} as API url. Status:')
         loop = asyncio.get_event_loop()
@@ -57,132 +109,221 @@ class TwitchBot(commands.Bot):
         self.logger.info(api_status.json())
 
     async def event_ready(self):
-        # Make sure we regularly check the API for a new status
-        asyncio.create_task(self._check_api_status())
-        self.logger.info(f'Logged in as | {self.nick}')
+        # twitchio fires this again after every reconnect, only start the background work once
+        if not self._background_started:
+            self._background_started = True
+            # Forward chat in the background and make sure we regularly check the API for a new status
+            await self.forwarder.start()
+            asyncio.create_task(self._check_api_status())
+            if self.report_queue is not None:
+                asyncio.create_task(self._report_shard_stats())
+            if self.control_queue is not None:
+                asyncio.create_task(self._follow_control())
+        self.logger.info(f'Logged in as | {self.nick}, shard {self.shard_index + 1}/{self.shard_count} '
+                         f'with channels {sorted(self.joined_channels)}')
 
     async def _check_api_status(self):
-        """Check the API for a new status continuously."""
+        """Follow the API status continuously.
+
+        Uses conditional requests on the status ETag, so an unchanged status costs a 304
+        without a body. With long-polling the API holds the request until the status
+        changes, so changes reach us right away.
+        """
+        etag = None
+        timeout = aiohttp.ClientTimeout(total=self.status_wait_timeout + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                headers = {'If-None-Match': etag} if etag else {}
+                try:
+                    if self.status_long_poll:
+                        resp = await session.get(
+                            self.twitch_status_wait_endpoint,
+                            params={'timeout': self.status_wait_timeout},
+                            headers=headers
+                        )
+                    else:
+                        resp = await session.get(self.twitch_status_endpoint, headers=headers)
+
+                    async with resp:
+                        if resp.status == 200:
+                            etag = resp.headers.get('ETag')
+                            await self._set_status(await resp.json())
+                        elif resp.status != 304:
+                            self.logger.warning(f'Unexpected status response: {resp.status}')
+                            if resp.status == 404:
+                                # older API without long-polling
+                                self.status_long_poll = False
+                            await asyncio.sleep(self.sec_between_check)
+                            continue
+                    if self.status_long_poll:
+                        # the API already waited for us, poll again right away
+                        continue
+                except Exception as ex:
+                    self.logger.error(ex)
+                await asyncio.sleep(self.sec_between_check)
+
+    async def _set_status(self, twitch_status):
+        if self.status != twitch_status:
+            self.status = twitch_status
+            self.logger.warning('Changed status!')
+            self.logger.warning(twitch_status)
+            await self._set_channels(self.shard_channels(twitch_status['channel_names']))
+
+    async def _set_channels(self, channel_names):
+        """Join new channels and leave the ones no longer in our shard."""
+        channel_names = set(channel_names)
+        to_join = channel_names - self.joined_channels
+        to_part = self.joined_channels - channel_names
+        if to_join:
+            await self.join_channels(channels=list(to_join))
+            self.joined_channels |= to_join
+        connection = getattr(self, '_connection', None)
+        if to_part:
+            if connection is None:
+                self.logger.warning(f'Not connected, cannot leave {sorted(to_part)} yet.')
+                to_part = set()
+            else:
+                # twitchio has no part_channels, so send the IRC command ourselves
+                for name in to_part:
+                    await connection.send(f'PART #{name}')
+                self.joined_channels -= to_part
+        if connection is not None:
+            # reconnects join the initial channels, keep them in line with ours
+            connection._initial_channels = sorted(self.joined_channels)
+        if to_join or to_part:
+            self.logger.warning(f'Shard {self.shard_index} joined {sorted(to_join)}, left {sorted(to_part)}')
+
+    async def _follow_control(self):
+        """Apply commands from the supervisor, such as a refreshed token."""
+        loop = asyncio.get_event_loop()
         while True:
             try:
-                twitch_status = r.get(self.twitch_status_endpoint).json()
-                if self.status != twitch_status:
-                    self.status = twitch_status
-                    self.logger.warning('Changed status!')
-                    self.logger.warning(twitch_status)
-                    await self.join_channels(channels=twitch_status['channel_names'])
-                await asyncio.sleep(self.sec_between_check)
+                command = await loop.run_in_executor(None, self.control_queue.get, True, 1.0)
+            except queue.Empty:
+                continue
+            if 'token' in command:
+                self.set_token(command['token'])
+
+    def set_token(self, token):
+        """Switch to a new OAuth token without dropping the IRC connection.
+
+        Twitch only checks the token when connecting, so the live connection keeps
+        working and the new token is used by any later reconnect.
+        """
+        self.token = token
+        connection = getattr(self, '_connection', None)
+        if connection is not None:
+            connection._token = token
+        http = getattr(self, '_http', None)
+        if http is not None:
+            http.token = token
+        self.logger.warning(f'Shard {self.shard_index} switched to a refreshed Twitch token.')
+
+    def _reset_shard_stats(self):
+        self.shard_stats = {
+            'messages': 0, 'lag_total': 0.0, 'lag_max': 0.0, 'cpu_total': 0.0, 'spam': 0, 'since': time.monotonic()
+        }
+
+    def _track_lag(self, message):
+        """Count the message and how long after Twitch sent it we got it."""
+        self.shard_stats['messages'] += 1
+        sent_ts = (getattr(message, 'tags', None) or {}).get('tmi-sent-ts')
+        if sent_ts:
+            lag = max(0.0, time.time() - int(sent_ts) / 1000)
+            self.shard_stats['lag_total'] += lag
+            self.shard_stats['lag_max'] = max(self.shard_stats['lag_max'], lag)
+
+    async def _report_shard_stats(self):
+        """Regularly send this shard's ingest stats to the supervisor."""
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            stats = self.shard_stats
+            self._reset_shard_stats()
+            try:
+                self.report_queue.put_nowait({
+                    'shard': self.shard_index,
+                    'channels': sorted(self.joined_channels),
+                    'messages': stats['messages'],
+                    'messages_per_second': stats['messages'] / (time.monotonic() - stats['since']),
+                    'avg_lag': stats['lag_total'] / stats['messages'] if stats['messages'] else 0.0,
+                    'max_lag': stats['lag_max'],
+                    'cpu_us_per_message': 1e6 * stats['cpu_total'] / stats['messages'] if stats['messages'] else 0.0,
+                    'spam_dropped': stats['spam'],
+                    'forward_queue': len(self.forwarder),
+                    'forward_dropped': self.forwarder.dropped
+                })
             except Exception as ex:
-                self.logger.error(ex)
-                await asyncio.sleep(self.sec_between_check)
+                self.logger.error(f'Could not report shard stats: {ex!r}')
 
-    @commands.command()
-    async def hello(self, ctx: commands.Context):
-        # Here we have a command hello, we can invoke our command with our prefix and command name
-        # e.g ?hello
-        # We can also give our commands aliases (different names) to invoke with.
-
-        # Send a hello back!
-        # Sending a reply back to the channel is easy... Below is an example.
-        self.logger.warning(f'Got a hello command from: {ctx.author.name}')
-        await ctx.send(f'/color Green Hello {ctx.author.name}!')
-        await self.send_message_to_api(ctx.message, command_type='greeting')
-
-    @commands.command()
-    async def talk(self, ctx: commands.Context):
-        """Tries to send a message using an avatar."""
-        self.logger.warning(ctx)
-        self.logger.warning(ctx.message)
-        self.logger.warning('---------------------- ')
-        self.logger.warning(ctx.message.content)
-        self.logger.warning(ctx.message.author)
-        self.logger.warning(ctx.author)
-        await self.send_message_to_api(ctx.message, command_type='talk')
-
-    @commands.command()
-    async def donate(self, ctx: commands.Context):
-        """User donation using creator token."""
-
-        self.logger.warning(f'Got a donation request from {ctx.message.author}:')
-        self.logger.warning(ctx.message.content)
-        try:
-            parts = ctx.message.content.split(' ')
-            amount = float(parts[1])
-            token_name = parts[2]
-            self.logger.warning(f'User {ctx.message.author.name} donates {amount} of {token_name}')
-            await self.send_message_to_api(ctx.message, command_type='donate')
-        except Exception as ex:
-            self.logger.error(ex)
+    def donate(self, message, args):
+        """User donation using creator token, e.g. ?donate 10 VCA"""
+        if args['amount'] <= 0:
+            return False
+        self.logger.info('User %s donates %s of %s', message.author.name, args['amount'], args['token'])
+        return True
+
+    async def run_command(self, message, name, text):
+        """Parse, check the cooldown and run a chat command, then forward it to the API."""
+        command = self.command_handlers.get(name)
+        if command is None:
+            return
+        spec, handler = command
+        args = spec.parse(text)
+        if args is None:
+            self.logger.debug('Invalid %s command from %s: %s', name, message.author.name, text)
+            return
+        if not self.cooldowns.ready(spec, message.author.id):
+            return
+        if handler is not None and not handler(message, args):
+            return
+        if spec.reply:
+            await message.channel.send(spec.reply.format(author_name=message.author.name, **args))
+        self.send_message_to_api(message, command_type=spec.command_type)
 
     async def event_message(self, message):
         # Messages with echo set to True are messages sent by the bot...
         # For now we just want to ignore them...
         if message.echo:
             return
+        started = time.perf_counter()
+        self._track_lag(message)
 
-        self.logger.info(f'[grey]{message.author.name} in {message.author.channel.name} - {message.content}[/grey]')
-
-        if message.content[0] != self.command_prefix:
-            await self.send_message_to_api(message)
-        # Since we have commands and are overriding the default `event_message`
-        # We must let the bot know we want to handle and invoke our commands...
-        await self.handle_commands(message)
-
-    def message_to_dict(self, message, command_type=None):
-        msg = {
-            'channel_name': message.author.channel.name,
-            'author_name': message.author.name,
-            'author_id': message.author.id,
-            'message_text': message.content,
-            'is_command': False,
-            'datetime': datetime.now().isoformat()
-        }
-        if command_type:
-            msg['is_command'] = True
-            msg['command_type'] = command_type
-
-        return msg
-
-    async def send_message_to_api(self, message, command_type=None):
-        msg_dict = self.message_to_dict(message, command_type=command_type)
-        # this function is already async so we don't bother with async request
-        try:
-            resp = r.post(
-                self.twitch_message_endpoint,
-                json=msg_dict
-            )
-            if not resp.status_code == 200:
-                self.logger.warning('Failed sending message:')
-                self.logger.warning(resp)
-                self.logger.warning(resp.status_code)
-                self.logger.warning(resp.text)
-                self.logger.warning(resp.json())
-        except Exception as ex:
-            self.logger.error('Failed sending message:')
-            self.logger.error(ex)
-
-
-def external_run_bot(cfg):
-    logger = logging.getLogger(__name__)
-    init_time = datetime.now()
-    token_exp_duration = timedelta(seconds=cfg['refresh']['expiration-seconds'])
-
-    bot = TwitchBot(cfg=cfg)
-    proc = multiprocessing.Process(target=bot.run, args=())
-    proc.start()
-
-    while True:
-        if datetime.now() - init_time > token_exp_duration:
-            logger.warning('Restarting Twitch bot...')
-            init_time = datetime.now()
-            proc.terminate()  # sends a SIGTERM
-            bot = TwitchBot(cfg=cfg)
-            proc = multiprocessing.Process(target=bot.run, args=())
-            proc.start()
-            logger.warning(':tada:Twitch bot restarted!:tada:')
+        self._log_counter += 1
+        if self._log_counter >= self.log_sample_every:
+            self._log_counter = 0
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info('[grey]%s in %s - %s[/grey]', message.author.name, message.channel.name, message.content)
+
+        content = message.content
+        is_command = content.startswith(self.command_prefix)
+        if self.spam_filter and self.spam_filter.check(message.channel.name, message.author.name, content,
+                                                       is_command=is_command):
+            self.shard_stats['spam'] += 1
+        elif not is_command:
+            self.send_message_to_api(message)
         else:
-            logger.info('Token refresh check passed.')
-            time.sleep(cfg['refresh']['expiration-check'])
+            # look the command up directly instead of going through twitchio's command parsing
+            name, _, text = content[1:].partition(' ')
+            await self.run_command(message, name, text)
+        self.shard_stats['cpu_total'] += time.perf_counter() - started
+
+    def message_to_record(self, message, command_type=None):
+        return ChatRecord(
+            message.channel.name,
+            message.author.name,
+            message.author.id,
+            message.content,
+            datetime.now(),
+            command_type=command_type
+        )
+
+    def send_message_to_api(self, message, command_type=None):
+        """Queue the message for the API, the forwarder sends it in the background."""
+        self.forwarder.put(self.message_to_record(message, command_type=command_type))
+
+    async def close(self):
+        await self.forwarder.close()
+        await super().close()
 
 
 def main():
@@ -1,8 +1,41 @@
+import time
+
 
 class BaseConnector:
-    """Parent class for API connectors."""
+    """Parent class for API connectors.
+
+    Keeps a small cache of responses, each entry is fresh for `cache_ttl` seconds.
+    """
+    cache_ttl = 0
+
     def __init__(self, cfg):
         self.cfg = cfg
+        self._cache = {}
 
     def _connect(self, options: dict):
         raise NotImplementedError
+
+    def _cache_lookup(self, key):
+        """Return (True, value) when `key` is cached and still fresh, (False, None) otherwise."""
+        hit = self._cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            return True, hit[1]
+        return False, None
+
+    def _cache_store(self, key, value):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, value)
+        return value
+
+    def _cached(self, key, fetch):
+        """Return the cached value for `key`, calling `fetch` when missing or expired."""
+        found, value = self._cache_lookup(key)
+        if found:
+            return value
+        return self._cache_store(key, fetch())
+
+    def invalidate(self, key=None):
+        """Drop cached responses, all of them or the one under `key`."""
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
@@ -1,10 +1,18 @@
 import logging
+import aiohttp
 import requests as r
+from requests.adapters import HTTPAdapter
 from connectors.base_connector import BaseConnector
 
 
 class JackConnector(BaseConnector):
-    """Connect to the Jack Bot API for chat and user info."""
+    """Connect to the Jack Bot API for chat and user info.
+
+    Requests share one keep-alive session, so one connector should live as long as
+    the app using it. Bot status, NFTs and users are cached for `cache-ttl` seconds
+    (from the `api` config section), use `invalidate` with 'status', 'nfts' or 'users'
+    to force a fresh fetch.
+    """
     def __init__(self, cfg):
         super().__init__(cfg)
         assert 'api' in cfg, 'Please supply a url or host/port combination for the Jack API.'
@@ -15,47 +23,119 @@ class JackConnector(BaseConnector):
             self.api_url = cfg['api']['url']
         self.twitch_status_url = self.api_url + '/twitch/status'
         self.twitch_messages_url = self.api_url + '/twitch/get_messages'
+        self.twitch_stats_url = self.api_url + '/twitch/stats'
         self.twitch_all_nfts_url = self.api_url + '/rally/all-nfts'
         self.twitch_all_users_url = self.api_url + '/user/all_infos'
+        self.pool_size = cfg['api'].get('pool-size', 4)
+        self.timeout = cfg['api'].get('timeout', 10)
+        self.cache_ttl = cfg['api'].get('cache-ttl', 5)
         self.logger = logging.getLogger(__name__)
 
         self._connect()
 
     def _connect(self):
-        res = r.get(self.api_url)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session = r.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _get(self, url, params=None):
+        return self.session.get(url, params=params, timeout=self.timeout).json()
+
+    def ping(self):
+        res = self.session.get(self.api_url, timeout=self.timeout)
         self.logger.info(res.status_code)
         self.logger.info(res.json())
+        return res.ok
 
     def get_twitch_bot_status(self):
-        return r.get(self.twitch_status_url).json()
+        return self._cached('status', lambda: self._get(self.twitch_status_url))
 
     def set_twitch_bot_status(self, new_status):
-        print(type(new_status))
-        res = r.patch(self.twitch_status_url, json=new_status)
+        res = self.session.patch(self.twitch_status_url, json=new_status, timeout=self.timeout)
+        self.invalidate('status')
         if res.status_code == 200:
             return 'Success!'
         else:
             return res.json()
 
-    def get_twitch_messages(self, seconds_history=None, channel_names=None):
-        url = self.twitch_messages_url
-        if any([seconds_history, channel_names]):
-            url += '?'
+    def get_twitch_messages(self, seconds_history=None, channel_names=None, after=None):
+        """Get messages. With a cursor in `after` this returns only newer messages and the next cursor."""
+        return self._get(self.twitch_messages_url, params={
+            'seconds_history': seconds_history,
+            'channel_names': channel_names,
+            'after': after
+        })
 
-        if seconds_history:
-            url += 'seconds_history=' + str(seconds_history)
-
-        if channel_names:
-            for channel_name in channel_names:
-                url += '&channel_names=' + channel_name
-        return r.get(url).json()
+    def get_twitch_stats(self, channel_names=None, top=5):
+        """Get rolling chat activity per channel and window."""
+        return self._get(self.twitch_stats_url, params={'channel_names': channel_names, 'top': top})
 
     def get_all_nfts(self):
-        return r.get(
-            self.twitch_all_nfts_url
-        ).json()
+        return self._cached('nfts', lambda: self._get(self.twitch_all_nfts_url))
 
     def get_all_users(self):
-        return r.get(
-            self.twitch_all_users_url
-        ).json()
+        return self._cached('users', lambda: self._get(self.twitch_all_users_url))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncJackConnector(JackConnector):
+    """The Jack API connector for asyncio code, on a pooled aiohttp session.
+
+    Same methods as `JackConnector`, only they have to be awaited: the shared getters
+    go through the async `_get` and `_cached`. The session is opened on first use, so
+    use the connector on one event loop.
+    """
+    def _connect(self):
+        self.session = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    async def _get(self, url, params=None):
+        async with self._session().get(url, params=aiohttp_params(params)) as resp:
+            return await resp.json()
+
+    async def _cached(self, key, fetch):
+        found, value = self._cache_lookup(key)
+        if found:
+            return value
+        return self._cache_store(key, await fetch())
+
+    async def ping(self):
+        async with self._session().get(self.api_url) as resp:
+            self.logger.info(resp.status)
+            self.logger.info(await resp.json())
+            return resp.status < 400
+
+    async def set_twitch_bot_status(self, new_status):
+        async with self._session().patch(self.twitch_status_url, json=new_status) as resp:
+            self.invalidate('status')
+            if resp.status == 200:
+                return 'Success!'
+            return await resp.json()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+
+def aiohttp_params(params):
+    """requests skips None values and repeats list values, aiohttp needs that spelled out."""
+    if not params:
+        return None
+    pairs = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            pairs.append((key, str(item)))
+    return pairs
@@ -1,5 +1,7 @@
 import logging
 import requests as r
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from connectors.base_connector import BaseConnector
 
 
@@ -12,44 +14,90 @@ def assert_token_set(method):
 
 
 class RallyConnector(BaseConnector):
-    """Connect to the Rally API for NFT and user info."""
+    """Connect to the Rally API for NFT and user info.
+
+    Requests share one keep-alive session and catalog requests run concurrently on a
+    bounded thread pool. Every request gives up after `timeout` seconds. NFT templates
+    and listings are cached for `cache-ttl` seconds, use `invalidate` to force a fresh
+    fetch.
+    """
     def __init__(self, cfg):
         super().__init__(cfg)
         self.logger = logging.getLogger(__name__)
         self.api_url = cfg['rally']['api-url']
         self.coin = cfg['rally']['coin']
         self.nft_template_ids = cfg['rally']['nft-template-ids']
+        self.max_concurrency = cfg['rally'].get('max-concurrency', 8)
+        self.cache_ttl = cfg['rally'].get('cache-ttl', 300)
+        self.timeout = cfg['rally'].get('timeout', 10)
         self.tokens = None
 
+        self._connect()
+
         self.logger.info(
             f'Rally connector looking for coin {self.coin} \n' +
             f'and the following NFT templates:\n {self.nft_template_ids}'
         )
 
+    def _connect(self):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session = r.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='rally')
+
+    def invalidate(self, nft_template_id=None):
+        """Drop cached templates and listings, for one template or all of them."""
+        if nft_template_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(('template', nft_template_id), None)
+            self._cache.pop(('nfts', nft_template_id), None)
+
     def set_app_tokens(self, token_dict):
         assert 'access_token' in token_dict, 'Missing access token!'
         assert 'refresh_token' in token_dict, 'Missing refresh token!'
         self.tokens = token_dict
         self.auth_header = {'Authorization': 'Bearer ' + token_dict['access_token']}
+        self.invalidate()
 
-    # @assert_token_set
-    def get_nft_templates(self):
-        templates = []
-        for id_ in self.nft_template_ids:
-            resp = r.get(
-                self.api_url + '/api/nft-templates/' + id_
+    def get_nft_template(self, nft_template_id):
+        def fetch():
+            resp = self.session.get(
+                self.api_url + '/api/nft-templates/' + nft_template_id,
+                timeout=self.timeout
             )
             self.logger.debug(resp.json())
-            templates.append(resp.json())
-        return templates
+            return resp.json()
+        return self._cached(('template', nft_template_id), fetch)
+
+    # @assert_token_set
+    def get_nft_templates(self):
+        return list(self.executor.map(self.get_nft_template, self.nft_template_ids))
 
     def get_nft(self, nft_template_id):
-        return r.get(
-            self.api_url + '/api/nfts',
-            params={'nftTemplateId': nft_template_id}
-        ).json()
+        def fetch():
+            return self.session.get(
+                self.api_url + '/api/nfts',
+                params={'nftTemplateId': nft_template_id},
+                timeout=self.timeout
+            ).json()
+        return self._cached(('nfts', nft_template_id), fetch)
+
+    def get_catalog(self):
+        """Fetch all templates and their NFTs concurrently, in about one round trip.
+
+        Returns the list of templates and a dict of NFTs by template id.
+        """
+        templates = [self.executor.submit(self.get_nft_template, id_) for id_ in self.nft_template_ids]
+        nfts = {id_: self.executor.submit(self.get_nft, id_) for id_ in self.nft_template_ids}
+        return (
+            [future.result() for future in templates],
+            {id_: future.result() for id_, future in nfts.items()}
+        )
 
     def get_account_info(self, username):
-        return r.get(
-            self.api_url + '/api/accounts/' + username
+        return self.session.get(
+            self.api_url + '/api/accounts/' + username,
+            timeout=self.timeout
         ).json()
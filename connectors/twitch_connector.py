@@ -36,6 +36,8 @@ class TwitchConnector(BaseConnector):
         # this will open your default browser and prompt you with the twitch verification website
         token, refresh_token = auth.authenticate()
         self.token = token
+        # keep the refresh token, so later refreshes don't need the browser
+        self.refresh_token = refresh_token
         return token
 
     def get_oauth_token_refresh(self):
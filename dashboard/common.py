@@ -0,0 +1,10 @@
+import streamlit as st
+from connectors.jack_connector import JackConnector
+
+
+@st.cache(allow_output_mutation=True)
+def get_connector(cfg):
+    """One pooled API connector, shared by all reruns and sessions."""
+    api = JackConnector(cfg)
+    api.ping()
+    return api
@@ -6,62 +6,101 @@ import streamlit as st
 import pandas as pd
 sys.path.insert(0, os.getcwd())  # so we can import from utils
 from utils import load_config, logging_setup  # noqa
-from connectors.jack_connector import JackConnector  # noqa
+from dashboard.common import get_connector  # noqa
 
 
-def get_messages(channel_name, seconds_history=None):
-    """Get latest messages from a twitch channel."""
-    if not seconds_history:
-        seconds_history = st.session_state.cfg['dash']['seconds_history']
+CHAT_COLUMNS = ['datetime', 'author_name', 'message_text']
 
-    return st.session_state.api.get_twitch_messages(
-        seconds_history=seconds_history,
-        channel_names=[channel_name]
-    )
+
+@st.cache(allow_output_mutation=True)
+def get_config(config_file):
+    """Load the config and set up logging once, not on every rerun."""
+    cfg = load_config(config_file)
+    logging_setup(log_level=cfg['log-level'])
+    return cfg
 
 
-def remove_dups(large_l):
-    """Remove duplicates, keep order."""
-    seen = set()
-    new_l = []
-    for d in large_l:
-        t = tuple(d.items())
-        if t not in seen:
-            seen.add(t)
-            new_l.append(d)
-    return new_l
+def get_new_messages(channel_name):
+    """Fetch the messages of a twitch channel we haven't seen yet.
+
+    Messages are kept in a buffer keyed by message id, so nothing shows up twice.
+    When the API restarted and started its ids over, the buffer starts over too.
+    """
+    if st.session_state.get('chat_channel') != channel_name:
+        st.session_state.chat_channel = channel_name
+        st.session_state.chat_cursor = -1
+        st.session_state.chat_messages = {}
+
+    res = st.session_state.api.get_twitch_messages(
+        seconds_history=st.session_state.cfg['dash']['seconds_history'],
+        channel_names=[channel_name],
+        after=st.session_state.chat_cursor
+    )
+    cursor = st.session_state.chat_cursor
+    if res['next_cursor'] < cursor or any(message['message_id'] <= cursor for message in res['messages']):
+        # the ids were reset, the old ones would hide new messages reusing them
+        st.session_state.chat_messages = {}
+    st.session_state.chat_cursor = res['next_cursor']
+    buffer = st.session_state.chat_messages
+    new_messages = [message for message in res['messages'] if message['message_id'] not in buffer]
+    for message in new_messages:
+        buffer[message['message_id']] = message
+    for message_id in list(buffer)[:-st.session_state.cfg['dash'].get('buffer_size', 1000)]:
+        del buffer[message_id]
+    return new_messages
+
+
+def show_chat_stats(placeholder, channel_name):
+    """Show the rolling chat activity of the channel, computed by the API."""
+    windows = st.session_state.api.get_twitch_stats(channel_names=[channel_name], top=3).get(channel_name, {})
+    placeholder.table(pd.DataFrame([
+        {
+            'window': window,
+            'messages/s': round(stats['messages_per_second'], 2),
+            'chatters': stats['unique_chatters'],
+            'top authors': ', '.join(author['author_name'] for author in stats['top_authors']),
+            'commands': ', '.join(f'{command}: {count}' for command, count in stats['command_types'].items())
+        }
+        for window, stats in windows.items()
+    ]))
 
 
 def show_twitch_chat():
-    """Main Twitch message screen."""
-    st.session_state.twitch_status = st.session_state.api.get_twitch_bot_status()
+    """Main Twitch message screen.
+
+    Polls for new messages inside this script run and only redraws the chat, newest
+    message first, when some came in, instead of rerunning the whole script.
+    """
+    twitch_status = st.session_state.api.get_twitch_bot_status()
     current_channel_name = st.sidebar.selectbox(
-        'Please select a channel', st.session_state.twitch_status['channel_names']
+        'Please select a channel', twitch_status['channel_names']
     )
 
     stopped = st.button('stop monitoring.')
-    if st.button('start monitoring.'):
-        st.experimental_rerun()
-    messages = get_messages(current_channel_name)
-    if not stopped:
-        chat_placeholder = st.empty()
-        new_messages = get_messages(current_channel_name)
-
-        messages = remove_dups(messages + new_messages)
-        df = pd.DataFrame(messages)
-        if len(messages) > 0:
-            chat_placeholder.table(
-                df[['datetime', 'author_name', 'message_text']].iloc[-10:][::-1]
-            )
+    # clicking reruns the script, which starts monitoring again
+    st.button('start monitoring.')
+    stats_placeholder = st.empty()
+    chat_placeholder = st.empty()
+    if stopped:
+        return
+
+    chat_rows = st.session_state.cfg['dash'].get('chat_rows', 10)
+    first = True
+    while True:
+        new_messages = get_new_messages(current_channel_name)
+        if first or new_messages:
+            rows = list(st.session_state.chat_messages.values())[-chat_rows:][::-1]
+            chat_placeholder.table(pd.DataFrame(rows, columns=CHAT_COLUMNS))
+            first = False
+        show_chat_stats(stats_placeholder, current_channel_name)
         time.sleep(st.session_state.cfg['dash']['seconds_refresh'])
-        st.experimental_rerun()
 
 
 def show_settings():
     """Show a settings page for changing the API state."""
-    st.session_state.twitch_status = st.session_state.api.get_twitch_bot_status()
     if st.button('Refresh'):
-        st.experimental_rerun()
+        st.session_state.api.invalidate('status')
+    st.session_state.twitch_status = st.session_state.api.get_twitch_bot_status()
 
     pretty_status = json.dumps(st.session_state.twitch_status, indent=4)
     status_field = st.text_area('API state:', value=pretty_status, height=400)
@@ -115,15 +154,11 @@ def check_credentials():
 
 
 def run_dash():
-    # so our experimental_rerun can go on for a bit longer
-    sys.setrecursionlimit(1500)
+    st.set_page_config(layout="wide")
 
-    cfg = load_config(os.environ['CONFIG_FILE'])
-    logging_setup(log_level=cfg['log-level'])
+    cfg = get_config(os.environ['CONFIG_FILE'])
     st.session_state.cfg = cfg
-    st.session_state.api = JackConnector(cfg)
-
-    st.set_page_config(layout="wide")
+    st.session_state.api = get_connector(cfg)
 
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
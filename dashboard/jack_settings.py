@@ -4,7 +4,7 @@ import logging
 import streamlit as st
 sys.path.insert(0, os.getcwd())  # so we can import from utils
 from utils import load_config, logging_setup  # noqa
-from connectors.jack_connector import JackConnector  # noqa
+from dashboard.common import get_connector  # noqa
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +18,7 @@ def run_dash():
     logging_setup(log_level=cfg['log-level'])
     logger.info(query_params := st.experimental_get_query_params())
     st.session_state.cfg = cfg
-    st.session_state.api = JackConnector(cfg)
+    st.session_state.api = get_connector(cfg)
     st.session_state.query_params = query_params
 
     if 'id' in query_params:
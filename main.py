@@ -4,7 +4,7 @@ import logging
 import os
 import subprocess
 from utils import load_config, logging_setup, run_osc_listener
-from bots.twitch_bot import external_run_bot
+from bots.supervisor import external_run_bot
 
 
 @click.command()
@@ -25,6 +25,8 @@ def main(config):
             port=cfg['api']['port'],
             reload_delay=1.0,
             reload=cfg['api']['reload'],
+            # more than one worker needs api.state.backend: sqlite to share the chat
+            workers=cfg['api'].get('workers', 1),
             factory=True,
             log_config=None
         )